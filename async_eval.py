@@ -0,0 +1,98 @@
+import queue
+
+import torch
+import torch.multiprocessing as mp
+
+
+def share_state(state, buffers=None):
+    """Copies a (nested) state dict into cpu tensors in shared memory.
+
+    buffers is the result of a previous call; its tensors are reused when the shapes still match, so the
+    shared memory is allocated once and later snapshots are just a device -> host copy.
+    """
+    if torch.is_tensor(state):
+        if buffers is None or not torch.is_tensor(buffers) or buffers.shape != state.shape or buffers.dtype != state.dtype:
+            buffers = torch.empty(state.shape, dtype=state.dtype).share_memory_()
+        buffers.copy_(state.detach())
+        return buffers
+    if isinstance(state, dict):
+        buffers = buffers if isinstance(buffers, dict) else {}
+        return {k: share_state(v, buffers.get(k)) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        buffers = buffers if isinstance(buffers, (list, tuple)) and len(buffers) == len(state) else [None] * len(state)
+        return type(state)(share_state(v, b) for v, b in zip(state, buffers))
+    return state
+
+
+class AsyncEvaluator(object):
+    """Runs online evaluation in a separate process while training goes on.
+
+    publish() copies the model / optimizer state into shared memory and hands it to the evaluator
+    process, which loads it into its own copy of the model, scores it, updates the best-metric
+    bookkeeping, saves the best checkpoints (with the GradScaler state of --amp fp16, passed as is)
+    and puts the result on a queue read by poll().
+    Only one snapshot is in flight: while the evaluator is busy, publish() returns False and the
+    step is skipped, so training never waits for it and the shared buffers are never overwritten
+    while being read.
+
+    worker(args, jobs, results) is the process entry point, it must be importable from the child.
+    The process is not daemonic, so its eval DataLoader can start workers; close() stops it. A worker
+    that dies raises in publish() / poll() instead of leaving the evaluator busy for good.
+    """
+
+    def __init__(self, worker, args):
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=worker, args=(args, self.jobs, self.results), daemon=False)
+        self.process.start()
+        self.buffers = None
+        self.busy = False
+
+    def check_alive(self):
+        if not self.process.is_alive():
+            raise RuntimeError('async evaluator exited with code {}'.format(self.process.exitcode))
+
+    def publish(self, global_step, model, optimizer, best_state, scaler_state=None):
+        self.check_alive()
+        if self.busy:
+            return False
+        self.buffers = share_state({'model': model.state_dict(), 'optimizer': optimizer.state_dict()}, self.buffers)
+        self.jobs.put({'global_step': global_step,
+                       'model': self.buffers['model'],
+                       'optimizer': self.buffers['optimizer'],
+                       'scaler': scaler_state,
+                       'best_state': best_state})
+        self.busy = True
+        return True
+
+    def poll(self, block=False):
+        """Returns the finished results: dicts with global_step, eval_measures and best_state.
+        Raises RuntimeError if the worker died with a snapshot in flight."""
+        results = []
+        while self.busy:
+            try:
+                result = self.results.get(block=block, timeout=1.0 if block else None)
+            except queue.Empty:
+                self.check_alive()
+                if block:
+                    continue
+                break
+            self.busy = False
+            results.append(result)
+        return results
+
+    def close(self, timeout=60.):
+        """Waits for the snapshot in flight and stops the evaluator. Returns its last results.
+        Never raises, it runs on every exit of the training loop."""
+        results = []
+        try:
+            results = self.poll(block=True)
+            self.jobs.put(None)
+            self.process.join(timeout)
+        except RuntimeError as e:
+            print(e)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        return results
@@ -0,0 +1,74 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugment(object):
+    """Training augmentation applied to a whole collated batch.
+
+    Does the same augmentation as DataLoadPreprocess.train_preprocess / augment_image / rotate_image
+    (random flip, gamma, brightness, per-channel color and small-angle rotation), but as broadcast
+    torch ops on a (B, 3, H, W) image batch in [0, 1] and a (B, 1, H, W) depth batch, so it can run
+    on the training device or once in the main process instead of per sample in every worker.
+    The image is ImageNet-normalized at the end, since the workers skip that in this mode.
+    """
+
+    def __init__(self, dataset='kitti', do_rotate=False, degree=1.0, normalize=True):
+        self.do_rotate = do_rotate
+        self.degree = degree
+        self.normalize = normalize
+        if dataset == 'nyu':
+            self.brightness_range = (0.75, 1.25)
+        else:
+            self.brightness_range = (0.9, 1.1)
+        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+    def sample_params(self, batch_size, device=None):
+        def uniform(low, high, *size):
+            return torch.empty(*size, device=device).uniform_(low, high)
+
+        do_augment = torch.rand(batch_size, device=device) > 0.5
+        neutral = torch.ones(batch_size, device=device)
+        params = {
+            'flip': torch.rand(batch_size, device=device) > 0.5,
+            'gamma': torch.where(do_augment, uniform(0.9, 1.1, batch_size), neutral),
+            'brightness': torch.where(do_augment, uniform(*self.brightness_range, batch_size), neutral),
+            'colors': torch.where(do_augment.unsqueeze(1), uniform(0.9, 1.1, batch_size, 3), neutral.unsqueeze(1).expand(-1, 3)),
+        }
+        if self.do_rotate:
+            params['angle'] = uniform(-self.degree, self.degree, batch_size)
+        return params
+
+    def rotate(self, image, depth, angle):
+        B, _, H, W = image.size()
+        theta = angle * math.pi / 180.0
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        # affine_grid works in normalized coordinates, rescale so the rotation is not sheared by the aspect ratio
+        affine = torch.stack([torch.stack([cos, -sin * H / W, torch.zeros_like(cos)], dim=1),
+                              torch.stack([sin * W / H, cos, torch.zeros_like(cos)], dim=1)], dim=1)
+        grid = F.affine_grid(affine.to(image.dtype), [B, 1, H, W], align_corners=False)
+        image = F.grid_sample(image, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        depth = F.grid_sample(depth, grid.to(depth.dtype), mode='nearest', padding_mode='zeros', align_corners=False)
+        return image, depth
+
+    def __call__(self, image, depth, params=None):
+        if params is None:
+            params = self.sample_params(image.size(0), device=image.device)
+        params = {k: v.to(image.device) for k, v in params.items()}
+
+        if 'angle' in params:
+            image, depth = self.rotate(image, depth, params['angle'])
+
+        flip = params['flip'].view(-1, 1, 1, 1)
+        image = torch.where(flip, image.flip(-1), image)
+        depth = torch.where(flip, depth.flip(-1), depth)
+
+        gamma = params['gamma'].view(-1, 1, 1, 1).to(image.dtype)
+        gain = (params['brightness'].view(-1, 1) * params['colors']).view(-1, 3, 1, 1).to(image.dtype)
+        image = image.pow(gamma).mul_(gain).clamp_(0, 1)
+
+        if self.normalize:
+            image = image.sub_(self.mean.to(image)).div_(self.std.to(image))
+        return image, depth
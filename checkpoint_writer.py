@@ -0,0 +1,140 @@
+import os
+import json
+import queue
+import threading
+
+import numpy as np
+import torch
+
+
+def cpu_copy(state):
+    """Detached cpu copy of a (nested) checkpoint, so training can go on while it is written."""
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, np.ndarray):
+        return state.copy()
+    if isinstance(state, dict):
+        return {k: cpu_copy(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_copy(v) for v in state)
+    return state
+
+
+def best_checkpoint_name(step, metric, value):
+    return "model-{}-best_{}_{:.5f}".format(step, metric, value)
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints from a background thread.
+
+    save() / save_best() take a cpu copy of the state on the calling thread and queue it, the thread
+    torch.saves it to a temporary file and renames it into place, so a checkpoint on disk is always
+    complete. A step that is the new best for several metrics is written once as model-<step>, the
+    usual model-<step>-best_<metric>_<value> names are hard links to it (symlinks, or only the json
+    index, where the file system has no links) and best_checkpoints.json maps every metric to its file.
+    model-<step> files that no metric points to anymore are deleted, except the keep_last most recent.
+    """
+
+    INDEX_NAME = "best_checkpoints.json"
+
+    def __init__(self, directory, keep_last=0, max_pending=2):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.index_path = os.path.join(directory, self.INDEX_NAME)
+        self.best = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.best = json.load(f)
+        # model-<step> files managed by the retention policy, oldest first
+        self.files = sorted(set(entry["file"] for entry in self.best.values()), key=lambda name: int(name.split("-")[1]))
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("checkpoint writer failed: {}".format(self.error))
+
+    def save(self, name, state):
+        self._check()
+        self.queue.put(("save", name, cpu_copy(state)))
+
+    def save_best(self, global_step, state, improved):
+        """improved: (metric, value, old best value, old best step) for every metric this step is the best for."""
+        self._check()
+        self.queue.put(("best", global_step, cpu_copy(state), list(improved)))
+
+    def wait(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if job[0] == "save":
+                    self._write(job[1], job[2])
+                else:
+                    self._write_best(*job[1:])
+            except Exception as e:
+                print("Checkpoint writer error: {}".format(e))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, name, state):
+        path = self._path(name)
+        tmp_path = path + ".tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _remove(self, name):
+        if os.path.lexists(self._path(name)):
+            os.remove(self._path(name))
+
+    def _link(self, name, link_name):
+        self._remove(link_name)
+        try:
+            os.link(self._path(name), self._path(link_name))
+        except (OSError, AttributeError):
+            try:
+                os.symlink(name, self._path(link_name))
+            except (OSError, NotImplementedError):
+                pass
+
+    def _write_best(self, global_step, state, improved):
+        name = "model-{}".format(global_step)
+        self._write(name, state)
+        if name not in self.files:
+            self.files.append(name)
+        for metric, value, old_best, old_best_step in improved:
+            link_name = best_checkpoint_name(global_step, metric, value)
+            self._link(name, link_name)
+            # also covers full best checkpoints written before this writer existed
+            self._remove(best_checkpoint_name(old_best_step, metric, old_best))
+            self.best[metric] = {"step": global_step, "value": value, "file": name, "link": link_name}
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.best, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+        self._apply_retention()
+
+    def _apply_retention(self):
+        referenced = set(entry["file"] for entry in self.best.values())
+        keep = set(self.files[-self.keep_last:]) if self.keep_last > 0 else set()
+        for name in self.files:
+            if name not in referenced and name not in keep:
+                self._remove(name)
+        self.files = [name for name in self.files if name in referenced or name in keep]
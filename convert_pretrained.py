@@ -0,0 +1,60 @@
+import os
+import time
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from models.model import VisionTransformer as ViT_seg
+from models.model import CONFIGS as CONFIGS_ViT_seg
+from models.model import converted_pretrained_path
+
+
+def build_model(vit_name, img_size, patches_size=16, num_classes=1, n_skip=3):
+    """The model main.py trains for vit_name at img_size (the token grid decides the Mixer token MLP shapes)."""
+    config_vit = CONFIGS_ViT_seg[vit_name]
+    config_vit.n_classes = num_classes
+    config_vit.n_skip = n_skip
+    if vit_name.find("R50") != -1:
+        config_vit.patches.grid = (int(img_size[0] / patches_size), int(img_size[1] / patches_size))
+    return ViT_seg(config_vit, img_size=img_size, num_classes=config_vit.n_classes), config_vit
+
+
+@torch.no_grad()
+def convert(model, pretrained_path, out_path=None):
+    """Runs model.load_from() on the npz once and saves every tensor it set, in torch layout, as a file that
+    VisionTransformer.load_pretrained() memory-maps instead of the npz. Returns the path and the number of tensors."""
+    out_path = out_path or converted_pretrained_path(pretrained_path)
+    loaded = model.load_from(weights=np.load(pretrained_path))
+    own_state = model.state_dict()
+    state_dict = OrderedDict((k, own_state[k].clone().contiguous()) for k in loaded)
+    tmp_path = out_path + ".tmp"
+    torch.save({"state_dict": state_dict, "source": os.path.basename(pretrained_path)}, tmp_path)
+    os.replace(tmp_path, out_path)
+    return out_path, len(state_dict)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the pretrained npz weights to memory-mappable torch files for load_pretrained().')
+    parser.add_argument('--vit_name',      type=str, help='models whose pretrained_path is converted', nargs='+', default=['R50-ViT-B_16', 'R50-Mixer-My_16'])
+    parser.add_argument('--input_height',  type=int, help='training input height (rcrop_height with random crop)', default=352)
+    parser.add_argument('--input_width',   type=int, help='training input width (rcrop_width with random crop)', default=704)
+    parser.add_argument('--patches_size',  type=int, help='patches_size, default is 16', default=16)
+    parser.add_argument('--num_classes',   type=int, help='output channel of network', default=1)
+    parser.add_argument('--n_skip',        type=int, help='using number of skip-connect', default=3)
+    args = parser.parse_args()
+
+    for vit_name in args.vit_name:
+        model, config_vit = build_model(vit_name, [args.input_height, args.input_width], patches_size=args.patches_size,
+                                        num_classes=args.num_classes, n_skip=args.n_skip)
+        start = time.time()
+        out_path, num_tensors = convert(model, config_vit.pretrained_path)
+        npz_time = time.time() - start
+
+        model, _ = build_model(vit_name, [args.input_height, args.input_width], patches_size=args.patches_size,
+                               num_classes=args.num_classes, n_skip=args.n_skip)
+        start = time.time()
+        loaded = model.load_pretrained(config_vit.pretrained_path)
+        print("{}: {} tensors of {} -> {} (npz load + convert {:.1f}s, loading {} {:.2f}s)".format(
+            vit_name, num_tensors, config_vit.pretrained_path, out_path, npz_time, loaded, time.time() - start))
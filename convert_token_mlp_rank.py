@@ -0,0 +1,60 @@
+import argparse
+from collections import OrderedDict
+
+import torch
+
+from models.model import LowRankLinear
+
+
+TOKEN_FCS = ("token_mlp_block.fc1.", "token_mlp_block.fc2.")
+
+
+def convert_state_dict(state_dict, rank):
+    """Replaces every dense token mixing fc (weight, bias) of a Mixer state dict by the u / v factors of
+    its rank truncated SVD, as loaded by a model with config.tokens_mlp_rank = rank.
+    Returns the new state dict and (key, dense params, low-rank params, relative error) per layer."""
+    converted = OrderedDict()
+    report = []
+    for key, value in state_dict.items():
+        prefix = key[:-len("weight")] if key.endswith("weight") else key[:-len("bias")]
+        if not prefix.endswith(TOKEN_FCS) or prefix + "weight" not in state_dict:
+            converted[key] = value
+            continue
+        if key.endswith("bias"):
+            continue
+        bias = state_dict.get(prefix + "bias")
+        layer = LowRankLinear(value.size(1), value.size(0), rank)
+        error = layer.load_dense(value, bias)
+        converted[prefix + "u.weight"] = layer.u.weight.detach().to(value.dtype)
+        converted[prefix + "v.weight"] = layer.v.weight.detach().to(value.dtype)
+        converted[prefix + "v.bias"] = layer.v.bias.detach().to(value.dtype)
+        dense = value.numel() + (bias.numel() if bias is not None else 0)
+        report.append((prefix[:-1], dense, sum(p.numel() for p in layer.parameters()), error))
+    return converted, report
+
+
+def convert_checkpoint(checkpoint_path, rank, out_path):
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    state_dict, report = convert_state_dict(checkpoint["model"], rank)
+    if not report:
+        raise ValueError("no dense token mixing MLP in '{}'".format(checkpoint_path))
+
+    for key, dense, low_rank, error in report:
+        print("{}: {} -> {} params, relative error {:.4f}".format(key, dense, low_rank, error))
+    print("token mixing MLP params: {} -> {}".format(sum(r[1] for r in report), sum(r[2] for r in report)))
+
+    # the optimizer state belongs to the dense parameters, the best measures are kept
+    converted = {k: v for k, v in checkpoint.items() if k != "optimizer"}
+    converted["model"] = state_dict
+    torch.save(converted, out_path)
+    print("Saved '{}', train it with a config with tokens_mlp_rank = {}".format(out_path, rank))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Initialize a low-rank token mixing MLP from a dense Mixer checkpoint by truncated SVD.')
+    parser.add_argument('--checkpoint_path', type=str, help='path to the dense checkpoint', required=True)
+    parser.add_argument('--rank',            type=int, help='rank of the token mixing fcs (tokens_mlp_rank)', required=True)
+    parser.add_argument('--out',             type=str, help='path of the converted checkpoint', required=True)
+    args = parser.parse_args()
+
+    convert_checkpoint(args.checkpoint_path, args.rank, args.out)
@@ -16,7 +16,9 @@
 
 import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler, SequentialSampler
+from torch.utils.data.dataloader import default_collate
+import torch.nn.functional as F
 import torch.utils.data.distributed
 from torchvision import transforms
 from PIL import Image
@@ -24,6 +26,9 @@ import os
 import random
 
 from distributed_sampler_no_evenly_divisible import *
+from kitti_pack import PackedShards
+from manifest import load_manifest
+from eval_cache import EvalSetCache
 
 
 
@@ -37,16 +42,78 @@ def _is_numpy_image(img):
     return isinstance(img, np.ndarray) and (img.ndim in {2, 3})
 
 
-def preprocessing_transforms(mode):
+def preprocessing_transforms(mode, normalize=True):
     return transforms.Compose([
-        ToTensor(mode=mode)
+        ToTensor(mode=mode, normalize=normalize)
     ])
 
 
+def pad_collate(batch, multiple=16):
+    """Collates eval / test samples of different size.
+
+    Images (and depth, if any) are zero-padded at the bottom / right to the largest size of the batch,
+    rounded up to `multiple` so the model can reshape the tokens. 'size' keeps the (h, w) of every
+    sample to crop the predictions back. Missing gt (depth False) becomes an all-zero depth map.
+    """
+    sizes = [tuple(sample['image'].shape[-2:]) for sample in batch]
+    height = -(-max(h for h, _ in sizes) // multiple) * multiple
+    width = -(-max(w for _, w in sizes) // multiple) * multiple
+
+    depth_dtype = torch.float32
+    for sample in batch:
+        if 'depth' in sample and sample.get('has_valid_depth', True) is not False:
+            depth_dtype = torch.as_tensor(sample['depth']).dtype
+            break
+
+    padded = []
+    for sample, (h, w) in zip(batch, sizes):
+        sample = dict(sample)
+        sample['image'] = F.pad(sample['image'], (0, width - w, 0, height - h))
+        if 'depth' in sample:
+            depth = torch.zeros((height, width, 1), dtype=depth_dtype)
+            if sample.get('has_valid_depth', True) is not False:
+                depth[:h, :w] = torch.as_tensor(sample['depth'])
+            sample['depth'] = depth
+        padded.append(sample)
+
+    collated = default_collate(padded)
+    collated['size'] = torch.tensor(sizes)
+    return collated
+
+
+class BucketBatchSampler(Sampler):
+    """Batches the indices of `sampler` so that every batch holds samples of a single shape."""
+
+    def __init__(self, sampler, shapes, batch_size):
+        self.sampler = sampler
+        self.shapes = shapes
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        buckets = {}
+        for idx in self.sampler:
+            bucket = buckets.setdefault(self.shapes[idx], [])
+            bucket.append(idx)
+            if len(bucket) == self.batch_size:
+                yield bucket
+                buckets[self.shapes[idx]] = []
+        for bucket in buckets.values():
+            if bucket:
+                yield bucket
+
+    def __len__(self):
+        counts = {}
+        for idx in self.sampler:
+            counts[self.shapes[idx]] = counts.get(self.shapes[idx], 0) + 1
+        return sum(-(-count // self.batch_size) for count in counts.values())
+
+
 class BtsDataLoader(object):
     def __init__(self, args, mode):
         if mode == 'train':
-            self.training_samples = DataLoadPreprocess(args, mode, transform=preprocessing_transforms(mode))
+            # With --batch_augment the workers leave flip / color / rotation and normalization to BatchAugment
+            normalize = not getattr(args, 'batch_augment', '') and not getattr(args, 'raw_transport', False)
+            self.training_samples = DataLoadPreprocess(args, mode, transform=preprocessing_transforms(mode, normalize))
             if args.distributed:
                 self.train_sampler = torch.utils.data.distributed.DistributedSampler(self.training_samples)
             else:
@@ -60,63 +127,117 @@ class BtsDataLoader(object):
                                    sampler=self.train_sampler)
 
         elif mode == 'online_eval':
-            self.testing_samples = DataLoadPreprocess(args, mode, transform=preprocessing_transforms(mode))
+            normalize = not getattr(args, 'raw_transport', False)
+            self.testing_samples = DataLoadPreprocess(args, mode, transform=preprocessing_transforms(mode, normalize))
+            # Lines known to have no gt are dropped up front instead of being skipped in every evaluation
+            has_gt = self.testing_samples.manifest.has_gt
+            if not has_gt.all():
+                self.testing_samples = torch.utils.data.Subset(self.testing_samples, np.flatnonzero(has_gt).tolist())
             if args.distributed:
                 # self.eval_sampler = torch.utils.data.distributed.DistributedSampler(self.testing_samples, shuffle=False)
                 self.eval_sampler = DistributedSamplerNoEvenlyDivisible(self.testing_samples, shuffle=False)
             else:
                 self.eval_sampler = None
-            self.data = DataLoader(self.testing_samples, 1,
-                                   shuffle=False,
+
+            batch_size = getattr(args, 'eval_batch_size', 1)
+            shapes = self.eval_shapes(args)
+            if batch_size > 1 and shapes is not None:
+                sampler = self.eval_sampler if self.eval_sampler is not None else SequentialSampler(self.testing_samples)
+                loader_kwargs = {'batch_sampler': BucketBatchSampler(sampler, shapes, batch_size)}
+            else:
+                loader_kwargs = {'batch_size': batch_size, 'shuffle': False, 'sampler': self.eval_sampler}
+            self.data = DataLoader(self.testing_samples,
                                    num_workers=1,
                                    pin_memory=True,
-                                   sampler=self.eval_sampler)
+                                   collate_fn=pad_collate,
+                                   # keeps the worker, and with it the eval cache, alive between evaluations
+                                   persistent_workers=getattr(args, 'eval_cache_mb', 0) > 0,
+                                   **loader_kwargs)
         
         elif mode == 'test':
             self.testing_samples = DataLoadPreprocess(args, mode, transform=preprocessing_transforms(mode))
-            self.data = DataLoader(self.testing_samples, 1, shuffle=False, num_workers=3)
+            # kept in file order, samples of another size are padded by pad_collate
+            self.data = DataLoader(self.testing_samples, getattr(args, 'batch_size', 1), shuffle=False, num_workers=3,
+                                   collate_fn=pad_collate)
 
         else:
             print('mode should be one of \'train, test, online_eval\'. Got {}'.format(mode))
+
+    def eval_shapes(self, args):
+        # post-kb-crop shape of every eval sample, None when it is unknown (or the same for all)
+        if args.do_kb_crop is True:
+            return None
+        dataset = self.testing_samples
+        indices = None
+        if isinstance(dataset, torch.utils.data.Subset):
+            dataset, indices = dataset.dataset, dataset.indices
+        manifest = dataset.manifest
+        if not manifest.probed:
+            return None
+        shapes = list(zip(manifest.height.tolist(), manifest.width.tolist()))
+        if indices is not None:
+            shapes = [shapes[i] for i in indices]
+        return shapes
             
             
 class DataLoadPreprocess(Dataset):
     def __init__(self, args, mode, transform=None, is_for_online_eval=False):
         self.args = args
         if mode == 'online_eval':
-            with open(args.filenames_file_eval, 'r') as f:
-                self.filenames = f.readlines()
+            self.manifest = load_manifest(getattr(args, 'manifest_file_eval', ''), args.filenames_file_eval)
         else:
-            with open(args.filenames_file, 'r') as f:
-                self.filenames = f.readlines()
+            self.manifest = load_manifest(getattr(args, 'manifest_file', ''), args.filenames_file)
     
         self.mode = mode
         self.transform = transform
         self.to_tensor = ToTensor
         self.is_for_online_eval = is_for_online_eval
+        self.batch_augment = mode == 'train' and bool(getattr(args, 'batch_augment', ''))
+        # uint8 image / uint16 depth go through the DataLoader, decode_raw_batch() converts them per batch
+        self.raw_transport = mode != 'test' and getattr(args, 'raw_transport', False)
+
+        # Pre-decoded, kb-cropped shards written by kitti_pack.py
+        if mode == 'online_eval':
+            packed_path = getattr(args, 'packed_data_path_eval', '')
+        else:
+            packed_path = getattr(args, 'packed_data_path', '')
+        self.packed = None
+        if packed_path:
+            if args.dataset != 'kitti' or args.do_kb_crop is not True:
+                raise ValueError('packed data only supports kitti with --do_kb_crop')
+            self.packed = PackedShards(packed_path)
+            if len(self.packed) != len(self.manifest):
+                raise ValueError('{} holds {} samples but the filenames file has {} lines'.format(
+                    packed_path, len(self.packed), len(self.manifest)))
+
+        self.eval_cache = None
+        if mode == 'online_eval' and self.packed is None and getattr(args, 'eval_cache_mb', 0) > 0:
+            self.eval_cache = EvalSetCache(args.eval_cache_mb * 1024 * 1024, shm_dir=getattr(args, 'eval_cache_shm', ''))
     
     def __getitem__(self, idx):
-        sample_path = self.filenames[idx]
-        focal = float(sample_path.split()[2])
+        focal = float(self.manifest.focal[idx])
 
         if self.mode == 'train':
-            if self.args.dataset == 'kitti' and self.args.use_right is True and random.random() > 0.5:
-                image_path = os.path.join(self.args.data_path, "./" + sample_path.split()[3])
-                depth_path = os.path.join(self.args.gt_path, "./" + sample_path.split()[4])
+            if self.packed is not None:
+                view = 1 if self.args.use_right is True and self.packed.has_view(idx, 1) and random.random() > 0.5 else 0
+                image, depth_gt = self.packed.get(idx, view)
+                if self.args.do_random_rotate is True and not self.batch_augment:
+                    image = Image.fromarray(image)
+                    depth_gt = Image.fromarray(depth_gt.astype(np.int32))
             else:
-                image_path = os.path.join(self.args.data_path, "./" + sample_path.split()[0])
-                depth_path = os.path.join(self.args.gt_path, "./" + sample_path.split()[1])
-
+                if self.args.dataset == 'kitti' and self.args.use_right is True and random.random() > 0.5:
+                    image_path = os.path.join(self.args.data_path, "./" + self.manifest.path(idx, 'rgb_right'))
+                    depth_path = os.path.join(self.args.gt_path, "./" + self.manifest.path(idx, 'depth_right'))
+                else:
+                    image_path = os.path.join(self.args.data_path, "./" + self.manifest.path(idx, 'rgb'))
+                    depth_path = os.path.join(self.args.gt_path, "./" + self.manifest.path(idx, 'depth'))
 
-            image = Image.open(image_path)
-            depth_gt = Image.open(depth_path)
+                image = Image.open(image_path)
+                depth_gt = Image.open(depth_path)
 
             
-            if self.args.do_kb_crop is True:
-                height = image.height
-                width = image.width
-                top_margin = int(height - 352)
-                left_margin = int((width - 1216) / 2)
+            if self.args.do_kb_crop is True and self.packed is None:
+                top_margin, left_margin = self.kb_crop_margins(idx, image.height, image.width)
                 depth_gt = depth_gt.crop((left_margin, top_margin, left_margin + 1216, top_margin + 352))
                 image = image.crop((left_margin, top_margin, left_margin + 1216, top_margin + 352))
             
@@ -125,24 +246,24 @@ class DataLoadPreprocess(Dataset):
                 depth_gt = depth_gt.crop((43, 45, 608, 472))
                 image = image.crop((43, 45, 608, 472))
     
-            if self.args.do_random_rotate is True:
+            if self.args.do_random_rotate is True and not self.batch_augment:
                 random_angle = (random.random() - 0.5) * 2 * self.args.degree
                 image = self.rotate_image(image, random_angle)
                 depth_gt = self.rotate_image(depth_gt, random_angle, flag=Image.NEAREST)
             
-            image = np.asarray(image, dtype=np.float32) / 255.0
-            depth_gt = np.asarray(depth_gt, dtype=np.float32)
-            depth_gt = np.expand_dims(depth_gt, axis=2)
-
-            if self.args.dataset == 'nyu':
-                depth_gt = depth_gt / 1000.0
-            else:
-                depth_gt = depth_gt / 256.0
+            image = self.image_to_array(image)
+            depth_gt = self.depth_to_array(depth_gt)
             
             if self.args.do_random_crop == "True":
                 image, depth_gt = self.random_crop(image, depth_gt, self.args.rcrop_height, self.args.rcrop_width)
-            image, depth_gt = self.train_preprocess(image, depth_gt)
-            sample = {'image': image, 'depth': depth_gt, 'focal': focal}
+            if self.raw_transport:
+                sample = {'image': image, 'depth': depth_gt, 'focal': focal}
+                if not self.batch_augment:
+                    sample['augment'] = self.sample_augment_params()
+            else:
+                if not self.batch_augment:
+                    image, depth_gt = self.train_preprocess(image, depth_gt)
+                sample = {'image': image, 'depth': depth_gt, 'focal': focal}
         
         else:
             if self.mode == 'online_eval':
@@ -150,33 +271,40 @@ class DataLoadPreprocess(Dataset):
             else:
                 data_path = self.args.data_path
 
-            image_path = os.path.join(data_path, "./" + sample_path.split()[0])
-            image = np.asarray(Image.open(image_path), dtype=np.float32) / 255.0
+            precropped = self.packed is not None or self.eval_cache is not None
+            if precropped:
+                if self.packed is not None:
+                    image, depth_gt = self.packed.get(idx)
+                else:
+                    image, depth_gt = self.cached_eval_sample(idx, data_path)
+                has_valid_depth = depth_gt is not None
+                image = self.image_to_array(image)
+                if has_valid_depth:
+                    depth_gt = self.depth_to_array(depth_gt)
+                else:
+                    depth_gt = False
+            else:
+                image_path = os.path.join(data_path, "./" + self.manifest.path(idx, 'rgb'))
+                image = self.image_to_array(Image.open(image_path))
 
-            if self.mode == 'online_eval':
+            if self.mode == 'online_eval' and not precropped:
                 gt_path = self.args.gt_path_eval
-                depth_path = os.path.join(gt_path, "./" + sample_path.split()[1])
+                depth_path = os.path.join(gt_path, "./" + self.manifest.path(idx, 'depth'))
                 has_valid_depth = False
-                try:
-                    depth_gt = Image.open(depth_path)
-                    has_valid_depth = True
-                except IOError:
-                    depth_gt = False
-                    # print('Missing gt for {}'.format(image_path))
+                depth_gt = False
+                if self.manifest.has_gt[idx]:
+                    try:
+                        depth_gt = Image.open(depth_path)
+                        has_valid_depth = True
+                    except IOError:
+                        depth_gt = False
+                        # print('Missing gt for {}'.format(image_path))
 
                 if has_valid_depth:
-                    depth_gt = np.asarray(depth_gt, dtype=np.float32)
-                    depth_gt = np.expand_dims(depth_gt, axis=2)
-                    if self.args.dataset == 'nyu':
-                        depth_gt = depth_gt / 1000.0
-                    else:
-                        depth_gt = depth_gt / 256.0
-
-            if self.args.do_kb_crop is True:
-                height = image.shape[0]
-                width = image.shape[1]
-                top_margin = int(height - 352)
-                left_margin = int((width - 1216) / 2)
+                    depth_gt = self.depth_to_array(depth_gt)
+
+            if self.args.do_kb_crop is True and not precropped:
+                top_margin, left_margin = self.kb_crop_margins(idx, image.shape[0], image.shape[1])
                 image = image[top_margin:top_margin + 352, left_margin:left_margin + 1216, :]
                 if self.mode == 'online_eval' and has_valid_depth:
                     depth_gt = depth_gt[top_margin:top_margin + 352, left_margin:left_margin + 1216, :]
@@ -191,6 +319,67 @@ class DataLoadPreprocess(Dataset):
         
         return sample
     
+    def cached_eval_sample(self, idx, data_path):
+        # decoded once, then served from EvalSetCache as kb-cropped uint8 / uint16
+        key = self.manifest.path(idx, 'rgb')
+        entry = self.eval_cache.get(key)
+        if entry is not None:
+            return entry
+
+        image = np.asarray(Image.open(os.path.join(data_path, "./" + key)), dtype=np.uint8)
+        depth_gt = None
+        if self.manifest.has_gt[idx]:
+            try:
+                depth_gt = np.asarray(Image.open(os.path.join(self.args.gt_path_eval, "./" + self.manifest.path(idx, 'depth'))))
+                depth_gt = depth_gt.astype(np.uint16)
+            except IOError:
+                depth_gt = None
+
+        if self.args.do_kb_crop is True:
+            top_margin, left_margin = self.kb_crop_margins(idx, image.shape[0], image.shape[1])
+            image = image[top_margin:top_margin + 352, left_margin:left_margin + 1216, :]
+            if depth_gt is not None:
+                depth_gt = depth_gt[top_margin:top_margin + 352, left_margin:left_margin + 1216]
+        return self.eval_cache.put(key, image, depth_gt)
+
+    def kb_crop_margins(self, idx, height, width):
+        if self.manifest.probed:
+            return int(self.manifest.top_margin[idx]), int(self.manifest.left_margin[idx])
+        return int(height - 352), int((width - 1216) / 2)
+
+    def image_to_array(self, image):
+        if self.raw_transport:
+            image = np.asarray(image, dtype=np.uint8)
+            return image if image.flags.writeable else image.copy()
+        return np.asarray(image, dtype=np.float32) / 255.0
+
+    def depth_to_array(self, depth_gt):
+        if self.raw_transport:
+            # torch has no uint16, the bits travel as int16 and are reinterpreted in decode_raw_batch()
+            depth_gt = np.asarray(depth_gt).astype(np.uint16).view(np.int16)
+        else:
+            depth_gt = np.asarray(depth_gt, dtype=np.float32)
+            if self.args.dataset == 'nyu':
+                depth_gt = depth_gt / 1000.0
+            else:
+                depth_gt = depth_gt / 256.0
+        return np.expand_dims(depth_gt, axis=2)
+
+    def sample_augment_params(self):
+        # Same draws as train_preprocess / augment_image, applied later on the batch by BatchAugment
+        do_flip = random.random() > 0.5
+        gamma, brightness, colors = 1.0, 1.0, np.ones(3)
+        if random.random() > 0.5:
+            gamma = random.uniform(0.9, 1.1)
+            if self.args.dataset == 'nyu':
+                brightness = random.uniform(0.75, 1.25)
+            else:
+                brightness = random.uniform(0.9, 1.1)
+            colors = np.random.uniform(0.9, 1.1, size=3)
+        return {'flip': torch.tensor(do_flip), 'gamma': torch.tensor(gamma, dtype=torch.float32),
+                'brightness': torch.tensor(brightness, dtype=torch.float32),
+                'colors': torch.tensor(colors, dtype=torch.float32)}
+
     def rotate_image(self, image, angle, flag=Image.BILINEAR):
         result = image.rotate(angle, resample=flag)
         return result
@@ -242,18 +431,37 @@ class DataLoadPreprocess(Dataset):
         return image_aug
     
     def __len__(self):
-        return len(self.filenames)
+        return len(self.manifest)
+
+
+def decode_raw_batch(image, depth, dataset, augment=None, params=None):
+    """Consumer side of --raw_transport.
+
+    Turns a collated uint8 image batch and int16-coded uint16 depth batch into the float tensors the
+    model expects: /255, depth /256 (kitti) or /1000 (nyu), then BatchAugment (with the parameters the
+    workers drew, if any) or plain ImageNet normalization. Runs on whatever device the tensors are on.
+    """
+    image = image.float().div_(255.0)
+    if torch.is_tensor(depth) and depth.dtype == torch.int16:
+        depth = (depth.int() & 0xFFFF).float().div_(1000.0 if dataset == 'nyu' else 256.0)
+
+    if augment is not None:
+        return augment(image, depth, params)
+    mean = torch.tensor([0.485, 0.456, 0.406], device=image.device).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225], device=image.device).view(1, 3, 1, 1)
+    return image.sub_(mean).div_(std), depth
 
 
 class ToTensor(object):
-    def __init__(self, mode):
+    def __init__(self, mode, normalize=True):
         self.mode = mode
-        self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]) if normalize else None
     
     def __call__(self, sample):
         image, focal = sample['image'], sample['focal']
         image = self.to_tensor(image)
-        image = self.normalize(image)
+        if self.normalize is not None:
+            image = self.normalize(image)
 
         if self.mode == 'test':
             return {'image': image, 'focal': focal}
@@ -261,6 +469,8 @@ class ToTensor(object):
         depth = sample['depth']
         if self.mode == 'train':
             depth = self.to_tensor(depth)
+            if 'augment' in sample:
+                return {'image': image, 'depth': depth, 'focal': focal, 'augment': sample['augment']}
             return {'image': image, 'depth': depth, 'focal': focal}
         else:
             has_valid_depth = sample['has_valid_depth']
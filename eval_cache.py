@@ -0,0 +1,86 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EvalSetCache(object):
+    """LRU cache of decoded, kb-cropped online-eval samples kept as uint8 image / uint16 depth.
+
+    Holds at most budget_bytes of arrays in the process. With shm_dir (e.g. /dev/shm/kitti_eval) each
+    sample is also written once as .npy files and read back memory-mapped, so every DDP rank on a node
+    shares one copy in the page cache. The LRU then only bounds the mappings held by this process.
+    """
+
+    def __init__(self, budget_bytes, shm_dir=''):
+        self.budget_bytes = budget_bytes
+        self.shm_dir = shm_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        if shm_dir and not os.path.isdir(shm_dir):
+            os.makedirs(shm_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def entry_bytes(entry):
+        image, depth = entry
+        return image.nbytes + (depth.nbytes if depth is not None else 0)
+
+    def _shm_paths(self, key):
+        name = key.replace('/', '_').replace('\\', '_')
+        return os.path.join(self.shm_dir, name + '.rgb.npy'), os.path.join(self.shm_dir, name + '.depth.npy')
+
+    def _load_shm(self, key):
+        image_path, depth_path = self._shm_paths(key)
+        # the image file is written last, so its presence means the entry is complete
+        if not os.path.isfile(image_path):
+            return None
+        depth = np.load(depth_path, mmap_mode='r') if os.path.isfile(depth_path) else None
+        return np.load(image_path, mmap_mode='r'), depth
+
+    def _save_shm(self, key, image, depth):
+        image_path, depth_path = self._shm_paths(key)
+        for path, array in ((depth_path, depth), (image_path, image)):
+            if array is None:
+                continue
+            tmp_path = '{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid())
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+
+    def _insert(self, key, entry):
+        self.entries[key] = entry
+        self.nbytes += self.entry_bytes(entry)
+        while self.nbytes > self.budget_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_bytes(evicted)
+
+    def get(self, key):
+        """Returns (image, depth or None) or None on a miss."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        if self.shm_dir:
+            entry = self._load_shm(key)
+            if entry is not None:
+                self._insert(key, entry)
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def put(self, key, image, depth=None):
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        depth = np.ascontiguousarray(depth, dtype=np.uint16) if depth is not None else None
+        if self.shm_dir:
+            self._save_shm(key, image, depth)
+            loaded = self._load_shm(key)
+            if loaded is not None:
+                image, depth = loaded
+        self._insert(key, (image, depth))
+        return image, depth
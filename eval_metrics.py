@@ -0,0 +1,122 @@
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+
+
+EVAL_METRICS = ["silog", "abs_rel", "log10", "rms", "sq_rel", "log_rms", "d1", "d2", "d3"]
+
+
+def kb_uncrop(pred, height, width):
+    """Places a kb-cropped (B, 1, 352, 1216) prediction back into a zero (B, 1, height, width) frame."""
+    top_margin = int(height - pred.size(-2))
+    left_margin = int((width - pred.size(-1)) / 2)
+    if top_margin == 0 and left_margin == 0 and pred.size(-1) == width:
+        return pred
+    return F.pad(pred, (left_margin, width - pred.size(-1) - left_margin, top_margin, 0))
+
+
+class DepthMetrics(object):
+    """Streaming KITTI depth metrics computed on the device the predictions live on.
+
+    update() takes a whole batch, masks the valid (and garg / eigen cropped) pixels of each sample and
+    adds the per-image metrics to a small accumulator, so nothing goes back to the host until compute().
+    The metrics are averaged over images, like compute_errors() in BTS.
+    """
+
+    def __init__(self, min_depth, max_depth, garg_crop=False, eigen_crop=False, device=None):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.garg_crop = garg_crop
+        self.eigen_crop = eigen_crop
+        # 9 metric sums + number of images
+        self.sums = torch.zeros(len(EVAL_METRICS) + 1, dtype=torch.float64, device=device)
+        self._crop_masks = {}
+
+    def crop_mask(self, height, width, device):
+        key = (height, width, str(device))
+        if key not in self._crop_masks:
+            mask = torch.zeros(height, width, dtype=torch.bool, device=device)
+            if self.garg_crop:
+                mask[int(0.40810811 * height):int(0.99189189 * height), int(0.03594771 * width):int(0.96405229 * width)] = True
+            elif self.eigen_crop:
+                mask[int(0.3324324 * height):int(0.91351351 * height), int(0.0359477 * width):int(0.96405229 * width)] = True
+            else:
+                mask[:] = True
+            self._crop_masks[key] = mask
+        return self._crop_masks[key]
+
+    @torch.no_grad()
+    def update(self, pred, gt, valid=None):
+        """pred, gt: (B, 1, H, W); valid: optional (B, 1, H, W) bool mask of real (unpadded) pixels."""
+        pred = pred.float()
+        gt = gt.to(pred.device, non_blocking=True).float()
+        pred = torch.nan_to_num(pred, nan=self.min_depth).clamp_(self.min_depth, self.max_depth)
+
+        mask = (gt > self.min_depth) & (gt < self.max_depth)
+        if self.garg_crop or self.eigen_crop:
+            mask &= self.crop_mask(gt.size(-2), gt.size(-1), gt.device)
+        if valid is not None:
+            mask &= valid
+
+        dims = tuple(range(1, gt.dim()))
+        count = mask.sum(dim=dims)
+        keep = count > 0
+        n = count.clamp(min=1).to(pred.dtype)
+        mask_f = mask.to(pred.dtype)
+
+        def masked_mean(x):
+            return (x * mask_f).sum(dim=dims) / n
+
+        gt = torch.where(mask, gt, torch.ones_like(gt))
+        pred = torch.where(mask, pred, torch.ones_like(pred))
+
+        thresh = torch.max(gt / pred, pred / gt)
+        diff = gt - pred
+        log_diff = torch.log(pred) - torch.log(gt)
+
+        silog = torch.sqrt((masked_mean(log_diff ** 2) - masked_mean(log_diff) ** 2).clamp(min=0)) * 100
+        abs_rel = masked_mean(diff.abs() / gt)
+        log10 = masked_mean((torch.log10(pred) - torch.log10(gt)).abs())
+        rms = torch.sqrt(masked_mean(diff ** 2))
+        sq_rel = masked_mean(diff ** 2 / gt)
+        log_rms = torch.sqrt(masked_mean(log_diff ** 2))
+        d1 = masked_mean((thresh < 1.25).to(pred.dtype))
+        d2 = masked_mean((thresh < 1.25 ** 2).to(pred.dtype))
+        d3 = masked_mean((thresh < 1.25 ** 3).to(pred.dtype))
+
+        per_image = torch.stack([silog, abs_rel, log10, rms, sq_rel, log_rms, d1, d2, d3], dim=1)
+        per_image = per_image[keep].to(self.sums.dtype)
+        self.sums[:-1] += per_image.sum(dim=0)
+        self.sums[-1] += per_image.size(0)
+
+    def all_reduce(self):
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.sums, op=dist.ReduceOp.SUM)
+
+    def compute(self):
+        """Returns a cpu float tensor: the 9 averaged metrics followed by the number of images."""
+        sums = self.sums.cpu()
+        cnt = sums[-1].clamp(min=1)
+        measures = torch.cat([sums[:-1] / cnt, sums[-1:]])
+        return measures.float()
+
+
+def update_best(eval_measures, global_step, best_lower, best_higher, best_steps):
+    """Updates the best-metric bookkeeping in place, the first 6 metrics are lower-is-better, the last 3 higher.
+
+    Returns (metric index, old best value, old best step) for every metric that improved.
+    """
+    improved = []
+    for i in range(len(EVAL_METRICS)):
+        measure = float(eval_measures[i])
+        if i < 6 and measure < best_lower[i]:
+            old_best = best_lower[i].item()
+            best_lower[i] = measure
+        elif i >= 6 and measure > best_higher[i - 6]:
+            old_best = best_higher[i - 6].item()
+            best_higher[i - 6] = measure
+        else:
+            continue
+        improved.append((i, old_best, int(best_steps[i])))
+        best_steps[i] = global_step
+    return improved
@@ -0,0 +1,142 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from models.model import CONFIGS as CONFIGS_ViT_seg
+from models.model import MixerBlock
+from models.inference import optimize_for_inference
+from models.meta_init import build_on_meta, materialize, strip_module_prefix
+
+
+def load_checkpoint_model(checkpoint_path, vit_name, img_size, num_classes=1, n_skip=3, vit_patches_size=16):
+    """Eval-mode VisionTransformer on the cpu with the weights of a main.py checkpoint, built as test.py does."""
+    config_vit = CONFIGS_ViT_seg[vit_name]
+    config_vit.n_classes = num_classes
+    config_vit.n_skip = n_skip
+    if vit_name.find("R50") != -1:
+        config_vit.patches.grid = (int(img_size[0] / vit_patches_size), int(img_size[1] / vit_patches_size))
+    model = build_on_meta(config_vit, img_size, config_vit.n_classes)
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", mmap=True)
+    # checkpoints come from the DataParallel / DDP wrapped model
+    model, missing = materialize(model, strip_module_prefix(checkpoint["model"]))
+    if missing:
+        raise KeyError("checkpoint '{}' misses {}".format(checkpoint_path, ", ".join(missing[:5])))
+    return model.eval()
+
+
+def export(model, onnx_path, height, width, batch_size=1, dynamic=False, opset=18):
+    """Writes model to onnx_path for (batch_size, 3, height, width) images.
+
+    The batch axis is always symbolic. With dynamic, height and width are too, in units of the token
+    stride (16, 16), so height and width have to be multiples of it. The padding to it is done by the
+    caller (OnnxModel) because the padding of the pytorch forward is traced for the export shape.
+    Mixer models resample their token mixing weights outside of the graph and are exported for a
+    fixed size.
+    """
+    stride = model.transformer.embeddings.stride
+    image = torch.zeros(batch_size, 3, height, width)
+    if dynamic and any(isinstance(layer, MixerBlock) for layer in model.transformer.encoder.layer):
+        print("Mixer models have a fixed token grid, exporting {}x{} with a dynamic batch only".format(height, width))
+        dynamic = False
+    dynamic_shapes = {"x": {0: torch.export.Dim("batch")}}
+    if dynamic:
+        if height % stride[0] or width % stride[1]:
+            raise ValueError("dynamic export needs a height and width divisible by {}".format(stride))
+        # in units of the stride, so the shape arithmetic of the ResNet skips and the token grid stays exact
+        dynamic_shapes["x"].update({2: stride[0] * torch.export.Dim("height_tokens", min=1),
+                                    3: stride[1] * torch.export.Dim("width_tokens", min=1)})
+    with torch.no_grad():
+        torch.onnx.export(model, (image,), onnx_path, input_names=["image"], output_names=["depth"],
+                          opset_version=opset, dynamo=True, dynamic_shapes=dynamic_shapes)
+
+    import onnx
+    onnx_model = onnx.load(onnx_path)
+    for key, value in (("stride", "{},{}".format(*stride)), ("dynamic", int(dynamic))):
+        entry = onnx_model.metadata_props.add()
+        entry.key, entry.value = key, str(value)
+    onnx.save(onnx_model, onnx_path)
+
+
+class OnnxModel(object):
+    """An export_onnx.py model run by onnxruntime on the cpu, called like the pytorch model with a
+    (B, 3, H, W) image array. Images are padded (zeros, bottom / right, as the pytorch forward does)
+    to the export size or, for dynamic exports, to the next multiple of the stride, and the depth is
+    cropped back."""
+
+    def __init__(self, onnx_path, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.stride = [int(s) for s in metadata.get("stride", "16,16").split(",")]
+        self.dynamic = bool(int(metadata.get("dynamic", 0)))
+        # None for symbolic axes
+        self.size = [d if isinstance(d, int) else None for d in self.session.get_inputs()[0].shape[2:]]
+
+    def padded_size(self, height, width):
+        if self.dynamic:
+            return -(-height // self.stride[0]) * self.stride[0], -(-width // self.stride[1]) * self.stride[1]
+        if height > self.size[0] or width > self.size[1]:
+            raise ValueError("image of {}x{} is larger than the export size {}x{}".format(height, width, *self.size))
+        return tuple(self.size)
+
+    def __call__(self, image):
+        image = np.ascontiguousarray(image, dtype=np.float32)
+        height, width = image.shape[-2:]
+        padded_height, padded_width = self.padded_size(height, width)
+        if (padded_height, padded_width) != (height, width):
+            image = np.pad(image, ((0, 0), (0, 0), (0, padded_height - height), (0, padded_width - width)))
+        depth = self.session.run(None, {self.input_name: image})[0]
+        return depth[:, :, :height, :width]
+
+
+def parity(model, onnx_model, image):
+    """Max absolute and relative difference of the onnxruntime depth to the pytorch depth."""
+    with torch.no_grad():
+        reference = model(torch.from_numpy(image)).numpy()
+    depth = onnx_model(image)
+    diff = np.abs(depth - reference)
+    return diff.max(), (diff / np.maximum(reference, 1e-3)).max()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a VisionTransformer checkpoint to ONNX.')
+    parser.add_argument('--checkpoint_path',    type=str, help='path to the checkpoint to export', required=True)
+    parser.add_argument('--out',                type=str, help='path of the onnx file', required=True)
+    parser.add_argument('--vit_name',           type=str, help='select one vit model', default='R50-ViT-B_16')
+    parser.add_argument('--num_classes',        type=int, help='output channel of network', default=1)
+    parser.add_argument('--n_skip',             type=int, help='using number of skip-connect', default=3)
+    parser.add_argument('--vit_patches_size',   type=int, help='vit_patches_size', default=16)
+    parser.add_argument('--img_size_height',    type=int, help='image height the model is built for (as in test.py)', default=352)
+    parser.add_argument('--img_size_width',     type=int, help='image width the model is built for (as in test.py)', default=1216)
+    parser.add_argument('--input_height',       type=int, help='height of the exported input', default=352)
+    parser.add_argument('--input_width',        type=int, help='width of the exported input', default=1216)
+    parser.add_argument('--batch_size',         type=int, help='batch size of the exported input', default=1)
+    parser.add_argument('--dynamic',                      help='if set, batch, height and width are dynamic axes', action='store_true')
+    parser.add_argument('--opset',              type=int, help='onnx opset version', default=18)
+    parser.add_argument('--optimize_inference',           help='if set, standardize the ResNet weights and fold the decoder batch norms before exporting', action='store_true')
+    parser.add_argument('--no_check',                     help='if set, skip the onnxruntime / pytorch parity check', action='store_true')
+    args = parser.parse_args()
+
+    model = load_checkpoint_model(args.checkpoint_path, args.vit_name, [args.img_size_height, args.img_size_width],
+                                  num_classes=args.num_classes, n_skip=args.n_skip, vit_patches_size=args.vit_patches_size)
+    if args.optimize_inference:
+        optimize_for_inference(model, inplace=True)
+
+    start = time.time()
+    export(model, args.out, args.input_height, args.input_width, batch_size=args.batch_size, dynamic=args.dynamic, opset=args.opset)
+    print("Exported '{}' in {:.1f}s".format(args.out, time.time() - start))
+
+    if not args.no_check:
+        onnx_model = OnnxModel(args.out)
+        image = np.random.RandomState(0).randn(args.batch_size, 3, args.input_height, args.input_width).astype(np.float32)
+        max_diff, max_rel = parity(model, onnx_model, image)
+        print("Parity with pytorch: max abs diff {:.2e}, max rel diff {:.2e}".format(max_diff, max_rel))
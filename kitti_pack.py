@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from manifest import split_lines
+
+
+# Every packed sample is kb-cropped, so all slots of a shard have the same stride
+PACK_HEIGHT = 352
+PACK_WIDTH = 1216
+
+
+def kb_crop(array, height=PACK_HEIGHT, width=PACK_WIDTH):
+    top_margin = int(array.shape[0] - height)
+    left_margin = int((array.shape[1] - width) / 2)
+    return array[top_margin:top_margin + height, left_margin:left_margin + width]
+
+
+class PackedShards(object):
+    """Read-only view of a directory written by pack().
+
+    Layout of a pack directory:
+        meta.json           height, width, samples_per_shard, num_shards, num_views
+        index.npz           per line of the filenames file and per view (left / right):
+                            shard id, byte offsets into the rgb and depth shard, has_depth flag
+                            plus the focal length of the line
+        rgb_XXXX.bin        uint8  [samples, height, width, 3]
+        depth_XXXX.bin      uint16 [samples, height, width]
+
+    Shards are opened lazily with np.memmap so that every DataLoader worker maps the
+    same files and the OS page cache is shared between them.
+    """
+
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        with open(os.path.join(pack_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        index = np.load(os.path.join(pack_dir, 'index.npz'))
+        self.shard = index['shard']
+        self.rgb_offset = index['rgb_offset']
+        self.depth_offset = index['depth_offset']
+        self.has_depth = index['has_depth']
+        self.focal = index['focal']
+
+        self.height = self.meta['height']
+        self.width = self.meta['width']
+        self.num_views = self.meta['num_views']
+        self.rgb_shape = (self.height, self.width, 3)
+        self.depth_shape = (self.height, self.width)
+        self._rgb = {}
+        self._depth = {}
+
+    def __len__(self):
+        return self.shard.shape[0]
+
+    def _open(self, cache, prefix, dtype, shard):
+        if shard not in cache:
+            path = os.path.join(self.pack_dir, '{}_{:04d}.bin'.format(prefix, shard))
+            cache[shard] = np.memmap(path, dtype=dtype, mode='r')
+        return cache[shard]
+
+    def has_view(self, idx, view):
+        return view < self.num_views and self.shard[idx, view] >= 0
+
+    def get(self, idx, view=0):
+        """Returns (rgb, depth) as zero-copy views into the shards; depth is None without gt."""
+        shard = int(self.shard[idx, view])
+        if shard < 0:
+            raise IndexError('view {} of sample {} is not packed'.format(view, idx))
+
+        rgb_buf = self._open(self._rgb, 'rgb', np.uint8, shard)
+        rgb_start = int(self.rgb_offset[idx, view])
+        rgb = rgb_buf[rgb_start:rgb_start + int(np.prod(self.rgb_shape))].reshape(self.rgb_shape)
+
+        depth = None
+        if self.has_depth[idx, view]:
+            depth_buf = self._open(self._depth, 'depth', np.uint16, shard)
+            depth_start = int(self.depth_offset[idx, view]) // 2
+            depth = depth_buf[depth_start:depth_start + int(np.prod(self.depth_shape))].reshape(self.depth_shape)
+        return rgb, depth
+
+
+def pack(filenames_file, data_path, gt_path, out_dir, samples_per_shard=1024, use_right=False):
+    """Decodes, kb-crops and writes every line of filenames_file into fixed-stride shards."""
+    with open(filenames_file, 'r') as f:
+        lines = split_lines(f.readlines())
+
+    num_views = 2 if use_right else 1
+    columns = [(0, 1), (3, 4)][:num_views]
+
+    entries = []
+    for i, line in enumerate(lines):
+        for view, (rgb_col, depth_col) in enumerate(columns):
+            if len(line) <= rgb_col:
+                continue
+            entries.append((i, view, line[rgb_col], line[depth_col] if len(line) > depth_col else 'None'))
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    rgb_stride = PACK_HEIGHT * PACK_WIDTH * 3
+    depth_stride = PACK_HEIGHT * PACK_WIDTH * 2
+
+    shard_index = np.full((len(lines), num_views), -1, dtype=np.int32)
+    rgb_offset = np.zeros((len(lines), num_views), dtype=np.int64)
+    depth_offset = np.zeros((len(lines), num_views), dtype=np.int64)
+    has_depth = np.zeros((len(lines), num_views), dtype=bool)
+    focal = np.array([float(line[2]) for line in lines], dtype=np.float32)
+
+    num_shards = (len(entries) + samples_per_shard - 1) // samples_per_shard
+    for shard in range(num_shards):
+        chunk = entries[shard * samples_per_shard:(shard + 1) * samples_per_shard]
+        rgb_out = np.memmap(os.path.join(out_dir, 'rgb_{:04d}.bin'.format(shard)), dtype=np.uint8, mode='w+',
+                            shape=(len(chunk), PACK_HEIGHT, PACK_WIDTH, 3))
+        depth_out = np.memmap(os.path.join(out_dir, 'depth_{:04d}.bin'.format(shard)), dtype=np.uint16, mode='w+',
+                              shape=(len(chunk), PACK_HEIGHT, PACK_WIDTH))
+
+        for slot, (i, view, rgb_name, depth_name) in enumerate(tqdm(chunk, desc='shard {}/{}'.format(shard + 1, num_shards))):
+            image = np.asarray(Image.open(os.path.join(data_path, "./" + rgb_name)).convert('RGB'), dtype=np.uint8)
+            rgb_out[slot] = kb_crop(image)
+
+            depth_path = os.path.join(gt_path, "./" + depth_name)
+            if depth_name != 'None' and os.path.isfile(depth_path):
+                depth = np.asarray(Image.open(depth_path), dtype=np.uint16)
+                depth_out[slot] = kb_crop(depth)
+                has_depth[i, view] = True
+
+            shard_index[i, view] = shard
+            rgb_offset[i, view] = slot * rgb_stride
+            depth_offset[i, view] = slot * depth_stride
+
+        rgb_out.flush()
+        depth_out.flush()
+        del rgb_out, depth_out
+
+    np.savez(os.path.join(out_dir, 'index.npz'), shard=shard_index, rgb_offset=rgb_offset,
+             depth_offset=depth_offset, has_depth=has_depth, focal=focal)
+    meta = {'height': PACK_HEIGHT, 'width': PACK_WIDTH, 'samples_per_shard': samples_per_shard,
+            'num_shards': num_shards, 'num_views': num_views, 'num_samples': len(lines),
+            'filenames_file': os.path.basename(filenames_file)}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    print('Packed {} images from {} lines into {} shards at {}'.format(len(entries), len(lines), num_shards, out_dir))
+
+
+def convert_arg_line_to_args(arg_line):
+    for arg in arg_line.split():
+        if not arg.strip():
+            continue
+        yield arg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack kb-cropped KITTI images and depth into memory-mapped shards.',
+                                     fromfile_prefix_chars='@')
+    parser.convert_arg_line_to_args = convert_arg_line_to_args
+    parser.add_argument('--filenames_file',    type=str, help='path to the filenames text file', default='./train_test_inputs/eigen_train_files_with_gt.txt')
+    parser.add_argument('--data_path',         type=str, help='path to the data', default='../dataset/kitti_dataset/')
+    parser.add_argument('--gt_path',           type=str, help='path to the groundtruth data', default='../dataset/kitti_dataset/data_depth_annotated/')
+    parser.add_argument('--out_dir',           type=str, help='directory to write the shards to', required=True)
+    parser.add_argument('--samples_per_shard', type=int, help='number of images per shard file', default=1024)
+    parser.add_argument('--use_right',                   help='if set, also pack the right images (columns 4 and 5)', action='store_true')
+
+    if sys.argv.__len__() == 2 and not sys.argv[1].startswith('-'):
+        args = parser.parse_args(['@' + sys.argv[1]])
+    else:
+        args = parser.parse_args()
+
+    pack(args.filenames_file, args.data_path, args.gt_path, args.out_dir,
+         samples_per_shard=args.samples_per_shard, use_right=args.use_right)
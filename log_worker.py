@@ -0,0 +1,97 @@
+import queue
+import threading
+from functools import lru_cache
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+@lru_cache(maxsize=None)
+def colormap_lut(cmap="Greys"):
+    """(256, 3) uint8 lookup table of a matplotlib colormap, built once per name."""
+    import matplotlib
+    import matplotlib.cm
+    try:
+        cmapper = matplotlib.colormaps[cmap]
+    except AttributeError:
+        cmapper = matplotlib.cm.get_cmap(cmap)
+    return cmapper(np.linspace(0, 1, 256), bytes=True)[:, :3].copy()
+
+
+def apply_lut(value, cmap="Greys"):
+    """Maps an (H, W) array in [0, 1] to a (3, H, W) uint8 image."""
+    index = np.clip(value * 255 + 0.5, 0, 255).astype(np.uint8)
+    return colormap_lut(cmap)[index].transpose((2, 0, 1))
+
+
+def normalize_depth(depth):
+    """(1, H, W) inverse depth scaled to [0, 1] for the TensorBoard images."""
+    vmin, vmax = depth.min(), depth.max()
+    if vmin != vmax:
+        return (depth - vmin) / (vmax - vmin)
+    return depth * 0.
+
+
+class LogWorker(object):
+    """Writes the TensorBoard images of the training loop from a background thread.
+
+    log_images() only downsamples the batch on the device, detaches it and queues it. The thread
+    copies it to the host, normalizes the inverse depth and the image, optionally colormaps the depth
+    through a lookup table and calls add_image / flush. When the queue is full the images of that
+    step are dropped instead of stalling training.
+    """
+
+    def __init__(self, writer, downscale=1, cmap="", max_pending=2):
+        self.writer = writer
+        self.downscale = max(int(downscale), 1)
+        self.cmap = cmap
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @torch.no_grad()
+    def log_images(self, global_step, image, depth_gt, depth_est, num_images=None):
+        num_images = image.size(0) if num_images is None else min(num_images, image.size(0))
+        image, depth_gt, depth_est = image[:num_images].detach(), depth_gt[:num_images].detach(), depth_est[:num_images].detach()
+        if self.downscale > 1:
+            image = F.avg_pool2d(image, self.downscale)
+            # nearest, so the sparse gt is not blurred with its holes
+            depth_gt = depth_gt[:, :, ::self.downscale, ::self.downscale]
+            depth_est = depth_est[:, :, ::self.downscale, ::self.downscale]
+        try:
+            self.queue.put_nowait((global_step, image.clone(), depth_gt.clone(), depth_est.clone()))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _depth_image(self, depth):
+        value = normalize_depth(1 / depth.numpy())
+        if self.cmap:
+            return apply_lut(value[0], self.cmap)
+        return value
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                global_step, image, depth_gt, depth_est = (x.cpu() if torch.is_tensor(x) else x for x in job)
+                depth_gt = torch.where(depth_gt < 1e-3, depth_gt * 0 + 1e3, depth_gt)
+                image = (image.float() * self.std + self.mean).clamp_(0, 1)
+                for i in range(image.size(0)):
+                    self.writer.add_image("depth_gt/image/{}".format(i), self._depth_image(depth_gt[i].float()), global_step)
+                    self.writer.add_image("depth_est/image/{}".format(i), self._depth_image(depth_est[i].float()), global_step)
+                    self.writer.add_image("image/image/{}".format(i), image[i], global_step)
+                self.writer.flush()
+            except Exception as e:
+                print("Log worker error: {}".format(e))
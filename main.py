@@ -26,7 +26,16 @@ from dataloader import *
 from models.model import VisionTransformer as ViT_seg
 from models.model import CONFIGS as CONFIGS_ViT_seg
 from models.model import *
+from models.grad_checkpoint import set_grad_checkpointing
+from models.compiled import compile_model, eval_shapes
+from models.meta_init import build_on_meta, materialize, materialize_pretrained, strip_module_prefix
 from plotgraph import plotgraph
+from batch_augment import BatchAugment
+from eval_metrics import EVAL_METRICS, DepthMetrics, kb_uncrop, update_best
+from async_eval import AsyncEvaluator
+from checkpoint_writer import CheckpointWriter, best_checkpoint_name
+from train_metrics import TrainMetrics
+from log_worker import LogWorker
 
 def convert_arg_line_to_args(arg_line):
     for arg in arg_line.split():
@@ -44,6 +53,7 @@ parser.add_argument("--dataset",                   type=str,   help="dataset to
 parser.add_argument("--data_path",                 type=str,   help="path to the data", default="../dataset/kitti_dataset/")
 parser.add_argument("--gt_path",                   type=str,   help="path to the groundtruth data", default="../dataset/kitti_dataset/data_depth_annotated/")
 parser.add_argument("--filenames_file",            type=str,   help="path to the filenames text file", default="./train_test_inputs/eigen_train_files_with_gt.txt")
+parser.add_argument("--manifest_file",             type=str,   help="manifest compiled by manifest.py from filenames_file, optional", default="")
 parser.add_argument("--input_height",              type=int,   help="input image height", default=352)
 parser.add_argument("--input_width",               type=int,   help="input image width",  default=1216)
 parser.add_argument("--max_depth",                 type=float, help="maximum depth in estimation", default=80)
@@ -53,6 +63,9 @@ parser.add_argument("--log_directory",             type=str,   help="directory t
 parser.add_argument("--checkpoint_path",           type=str,   help="path to a checkpoint to load", default="")
 parser.add_argument("--log_freq",                  type=int,   help="Logging frequency in global steps", default=100)
 parser.add_argument("--save_freq",                 type=int,   help="Checkpoint saving frequency in global steps", default=500)
+parser.add_argument("--log_image_downscale",       type=int,   help="downscale factor of the depth / image summaries", default=1)
+parser.add_argument("--log_cmap",                  type=str,   help="matplotlib colormap for the depth summaries, grayscale if empty", default="")
+parser.add_argument("--keep_checkpoints",          type=int,   help="number of recent best-checkpoint files to keep after they stop being the best for any metric", default=0)
 
 # # Training
 parser.add_argument("--fix_first_conv_blocks",                 help="if set, will fix the first two conv blocks", action="store_true")
@@ -65,6 +78,12 @@ parser.add_argument("--batch_size",                type=int,   help="batch size"
 parser.add_argument("--num_epochs",                type=int,   help="number of epochs", default=30)
 parser.add_argument("--learning_rate",             type=float, help="initial learning rate", default=1e-3)
 parser.add_argument("--end_learning_rate",         type=float, help="end learning rate", default=-1)
+parser.add_argument("--grad_checkpoint",           type=str,   help="activation checkpointing policy, comma separated: blocks:k (every k-th encoder block), "
+                                                                    "stages (every ResNet stage) or budget:MB (largest blocks/stages until the rest fits)", default="")
+parser.add_argument("--amp",                       type=str,   help="mixed precision for the model and the loss: fp16 (with loss scaling) or bf16, fp32 if empty", default="", choices=["", "fp16", "bf16"])
+parser.add_argument("--compile",                   type=str,   help="compile the model for the training and the online eval shapes at startup: "
+                                                                    "inductor (torch.compile, falls back to script if it fails) or script (TorchScript traces, eval only)", default="", choices=["", "inductor", "script"])
+parser.add_argument("--compile_mode",              type=str,   help="torch.compile mode, e.g. reduce-overhead or max-autotune", default=None)
 parser.add_argument("--variance_focus",            type=float, help="lambda in paper: [0, 1], higher value more focus on minimizing variance of error", default=0.85)
 
 # # Preprocessing
@@ -75,6 +94,10 @@ parser.add_argument("--rcrop_width",               type=int,   help="input image
 parser.add_argument("--degree",                    type=float, help="random rotation maximum degree", default=1.0)
 parser.add_argument("--do_kb_crop",                            help="if set, crop input images as kitti benchmark images", action="store_true")
 parser.add_argument("--use_right",                             help="if set, will randomly use right images when train on KITTI", action="store_true")
+parser.add_argument("--packed_data_path",          type=str,   help="directory of shards written by kitti_pack.py, replaces PNG decoding when set", default="")
+parser.add_argument("--batch_augment",             type=str,   help="run flip/color/rotate augmentation on whole batches instead of in the workers: "
+                                                                    "host (main process, before the copy to gpu) or device (on the training gpu)", default="", choices=["", "host", "device"])
+parser.add_argument("--raw_transport",                         help="if set, workers send uint8 images and uint16 depth, scaling and normalization happen per batch", action="store_true")
 
 # # Multi-gpu training
 parser.add_argument("--num_threads",               type=int,   help="number of threads to use for data loading", default=1)
@@ -92,6 +115,11 @@ parser.add_argument("--do_online_eval",                        help="if set, per
 parser.add_argument("--data_path_eval",            type=str,   help="path to the data for online evaluation", default="../dataset/kitti_dataset/")
 parser.add_argument("--gt_path_eval",              type=str,   help="path to the groundtruth data for online evaluation", default="../dataset/kitti_dataset/data_depth_annotated/")
 parser.add_argument("--filenames_file_eval",       type=str,   help="path to the filenames text file for online evaluation", default="./train_test_inputs/eigen_test_files_with_gt.txt")
+parser.add_argument("--manifest_file_eval",        type=str,   help="manifest compiled by manifest.py from filenames_file_eval, optional", default="")
+parser.add_argument("--packed_data_path_eval",     type=str,   help="directory of shards written by kitti_pack.py for online evaluation", default="")
+parser.add_argument("--eval_batch_size",           type=int,   help="batch size for online evaluation, samples are grouped by size", default=1)
+parser.add_argument("--eval_cache_mb",             type=int,   help="if > 0, keep decoded online eval samples in an LRU cache of this many MB", default=0)
+parser.add_argument("--eval_cache_shm",            type=str,   help="directory on /dev/shm backing the eval cache, shared by all ranks of a node", default="")
 parser.add_argument("--min_depth_eval",            type=float, help="minimum depth for evaluation", default=1e-3)
 parser.add_argument("--max_depth_eval",            type=float, help="maximum depth for evaluation", default=80)
 parser.add_argument("--eigen_crop",                            help="if set, crops according to Eigen NIPS14", action="store_true")
@@ -99,6 +127,8 @@ parser.add_argument("--garg_crop",                             help="if set, cro
 parser.add_argument("--eval_freq",                 type=int,   help="Online evaluation frequency in global steps", default=500)
 parser.add_argument("--eval_summary_directory",    type=str,   help="output directory for eval summary,"
                                                                     "if empty outputs to checkpoint folder", default="./outputs/eval")
+parser.add_argument("--async_eval",                            help="if set, online eval runs on weight snapshots in a separate process while training continues", action="store_true")
+parser.add_argument("--async_eval_gpu",            type=int,   help="GPU id for the async evaluator, defaults to the GPU of the first rank", default=None)
 
 # # # TransUnet/TransUNet args
 parser.add_argument("--num_classes",                type=int,  help="output channel of network", default=1)
@@ -127,36 +157,15 @@ elif args.mode == "train" and args.checkpoint_path:
         vars()[key] = val
 
 
-inv_normalize = transforms.Normalize(
-    mean=[-0.485/0.229, -0.456/0.224, -0.406/0.225],
-    std=[1/0.229, 1/0.224, 1/0.225]
-)
+eval_metrics = EVAL_METRICS
 
-eval_metrics = ["silog", "abs_rel", "log10", "rms", "sq_rel", "log_rms", "d1", "d2", "d3"]
+AMP_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
 
 
-def compute_errors(gt, pred):
-    thresh = np.maximum((gt / pred), (pred / gt))
-    d1 = (thresh < 1.25).mean()
-    d2 = (thresh < 1.25 ** 2).mean()
-    d3 = (thresh < 1.25 ** 3).mean()
+def autocast(device_type):
+    """Mixed precision region of --amp (a no-op without it) on the device type the model runs on."""
+    return torch.autocast(device_type, dtype=AMP_DTYPES.get(args.amp, torch.float16), enabled=bool(args.amp))
 
-    rms = (gt - pred) ** 2
-    rms = np.sqrt(rms.mean())
-
-    log_rms = (np.log(gt) - np.log(pred)) ** 2
-    log_rms = np.sqrt(log_rms.mean())
-
-    abs_rel = np.mean(np.abs(gt - pred) / gt)
-    sq_rel = np.mean(((gt - pred) ** 2) / gt)
-
-    err = np.log(pred) - np.log(gt)
-    silog = np.sqrt(np.mean(err ** 2) - np.mean(err) ** 2) * 100
-
-    err = np.abs(np.log10(pred) - np.log10(gt))
-    log10 = np.mean(err)
-
-    return [silog, abs_rel, log10, rms, sq_rel, log_rms, d1, d2, d3]
 
 def block_print():
     sys.stdout = open(os.devnull, "w")
@@ -171,98 +180,44 @@ def get_num_lines(file_path):
     f.close()
     return len(lines)
 
-def colorize(value, vmin=None, vmax=None, cmap="Greys"):
-    value = value.cpu().numpy()[:, :, :]
-    value = np.log10(value)
-
-    vmin = value.min() if vmin is None else vmin
-    vmax = value.max() if vmax is None else vmax
-
-    if vmin != vmax:
-        value = (value - vmin) / (vmax - vmin)
-    else:
-        value = value*0.
-
-    cmapper = matplotlib.cm.get_cmap(cmap)
-    value = cmapper(value, bytes=True)
-
-    img = value[:, :, :3]
-
-    return img.transpose((2, 0, 1))
-
-def normalize_result(value, vmin=None, vmax=None):
-    value = value.cpu().numpy()[0, :, :]
-
-    vmin = value.min() if vmin is None else vmin
-    vmax = value.max() if vmax is None else vmax
-
-    if vmin != vmax:
-        value = (value - vmin) / (vmax - vmin)
-    else:
-        value = value * 0.
-
-    return np.expand_dims(value, 0)
-
-
-
 def online_eval(model, dataloader_eval, gpu, ngpus):
-    eval_measures = torch.zeros(10).cuda(device=gpu)
+    device = torch.device("cuda", gpu) if gpu is not None else torch.device("cuda")
+    metrics = DepthMetrics(args.min_depth_eval, args.max_depth_eval, args.garg_crop, args.eigen_crop, device=device)
     for _, eval_sample_batched in enumerate(tqdm(dataloader_eval.data)):
         with torch.no_grad():
             image = torch.autograd.Variable(eval_sample_batched["image"].cuda(gpu, non_blocking=True))
             focal = torch.autograd.Variable(eval_sample_batched["focal"].cuda(gpu, non_blocking=True))
             gt_depth = eval_sample_batched["depth"]
             has_valid_depth = eval_sample_batched["has_valid_depth"]
-            if not has_valid_depth:
+            if not has_valid_depth.any():
                 # print("Invalid depth. continue.")
                 continue
+            gt_depth = gt_depth.cuda(gpu, non_blocking=True).permute(0, 3, 1, 2)
+            if args.raw_transport:
+                image, gt_depth = decode_raw_batch(image, gt_depth, args.dataset)
             
             # eval일때는 random_crop(352, 704)를 안해줘서 decoder 들어가기 직전 reshape 부분을 [352, 1216] shape으로 바꿔줘야한다.
-            depth_est = model(image, reshape_size = [352, 1216])
-
-            depth_est = depth_est.cpu().numpy().squeeze()
-            gt_depth = gt_depth.cpu().numpy().squeeze()
-
-        if args.do_kb_crop:
-            height, width = gt_depth.shape
-            top_margin = int(height - 352)
-            left_margin = int((width - 1216) / 2)
-            depth_est_uncropped = np.zeros((height, width), dtype=np.float32)
-            depth_est_uncropped[top_margin:top_margin + 352, left_margin:left_margin + 1216] = depth_est
-            depth_est = depth_est_uncropped
-
-        depth_est[depth_est < args.min_depth_eval] = args.min_depth_eval
-        depth_est[depth_est > args.max_depth_eval] = args.max_depth_eval
-        depth_est[np.isinf(depth_est)] = args.max_depth_eval
-        depth_est[np.isnan(depth_est)] = args.min_depth_eval
-
-        valid_mask = np.logical_and(gt_depth > args.min_depth_eval, gt_depth < args.max_depth_eval)
-
-        if args.garg_crop or args.eigen_crop:
-            gt_height, gt_width = gt_depth.shape
-            eval_mask = np.zeros(valid_mask.shape)
-
-            if args.garg_crop:
-                eval_mask[int(0.40810811 * gt_height):int(0.99189189 * gt_height), int(0.03594771 * gt_width):int(0.96405229 * gt_width)] = 1
-
-            elif args.eigen_crop:
-                eval_mask[int(0.3324324 * gt_height):int(0.91351351 * gt_height), int(0.0359477 * gt_width):int(0.96405229 * gt_width)] = 1
-                
-            valid_mask = np.logical_and(valid_mask, eval_mask)
-
-        measures = compute_errors(gt_depth[valid_mask], depth_est[valid_mask])
-
-        eval_measures[:9] += torch.tensor(measures).cuda(device=gpu)
-        eval_measures[9] += 1
+            # (the model derives it from the input now, any size works)
+            with autocast(image.device.type):
+                depth_est = model(image)
+            depth_est = depth_est.float()
+
+            # samples without gt carry an all-zero depth map and are skipped by DepthMetrics
+            sizes = eval_sample_batched["size"].tolist()
+            if all(size == sizes[0] for size in sizes) and tuple(sizes[0]) == tuple(image.shape[-2:]):
+                if args.do_kb_crop:
+                    depth_est = kb_uncrop(depth_est, gt_depth.size(-2), gt_depth.size(-1))
+                metrics.update(depth_est, gt_depth)
+            else:
+                for i, (h, w) in enumerate(sizes):
+                    metrics.update(depth_est[i:i + 1, :, :h, :w], gt_depth[i:i + 1, :, :h, :w])
 
     if args.multiprocessing_distributed:
-        group = dist.new_group([i for i in range(ngpus)])
-        dist.all_reduce(tensor=eval_measures, op=dist.ReduceOp.SUM, group=group)
+        metrics.all_reduce()
 
     if not args.multiprocessing_distributed or gpu == 0:
-        eval_measures_cpu = eval_measures.cpu()
+        eval_measures_cpu = metrics.compute()
         cnt = eval_measures_cpu[9].item()
-        eval_measures_cpu /= cnt
         print("Computing errors for {} eval samples".format(int(cnt)))
         print("{:>7}, {:>7}, {:>7}, {:>7}, {:>7}, {:>7}, {:>7}, {:>7}, {:>7}".format("silog", "abs_rel", "log10", "rms",
                                                                                      "sq_rel", "log_rms", "d1", "d2",
@@ -274,6 +229,135 @@ def online_eval(model, dataloader_eval, gpu, ngpus):
 
     return None
 
+def convert_legacy_optimizer_state(model, optimizer_state):
+    """Optimizer state of a checkpoint saved before Attention packed query / key / value, for the packed model.
+
+    The per-tensor state (momentum buffers) of query, key and value is concatenated like their weights in
+    Attention._load_from_state_dict. Returns None when the saved parameters do not line up with the model.
+    """
+    # legacy parameter indices every parameter of the model is made of, the legacy order is
+    # query.weight, query.bias, key.weight, key.bias, value.weight, value.bias where qkv is now
+    sources, index = [], 0
+    for name, _ in model.named_parameters():
+        if name.endswith(".qkv.bias"):
+            continue
+        if name.endswith(".qkv.weight"):
+            sources += [[index, index + 2, index + 4], [index + 1, index + 3, index + 5]]
+            index += 6
+        else:
+            sources.append([index])
+            index += 1
+    params = [p for group in optimizer_state["param_groups"] for p in group["params"]]
+    if len(params) != index:
+        return None
+    new_index = {params[ids[0]]: i for i, ids in enumerate(sources)}
+    state = {}
+    for i, ids in enumerate(sources):
+        entries = [optimizer_state["state"].get(params[j]) for j in ids]
+        if all(entry is None for entry in entries):
+            continue
+        if any(entry is None for entry in entries):
+            return None
+        state[i] = {key: torch.cat([entry[key] for entry in entries]) if torch.is_tensor(value) and value.dim() else value
+                    for key, value in entries[0].items()}
+    param_groups = [dict(group, params=[new_index[p] for p in group["params"] if p in new_index])
+                    for group in optimizer_state["param_groups"]]
+    return {"state": state, "param_groups": param_groups}
+
+def save_best_checkpoints(checkpoint_writer, improved, eval_measures, global_step, model_state, optimizer_state, best_state, scaler_state=None):
+    if not improved:
+        return
+    best_eval_measures_lower_better, best_eval_measures_higher_better, best_eval_steps = best_state
+    checkpoint = {"global_step": global_step,
+                  "model": model_state,
+                  "optimizer": optimizer_state,
+                  "best_eval_measures_higher_better": best_eval_measures_higher_better,
+                  "best_eval_measures_lower_better": best_eval_measures_lower_better,
+                  "best_eval_steps": best_eval_steps
+                  }
+    if scaler_state is not None:
+        checkpoint["scaler"] = scaler_state
+    # written once per step, the per-metric best names link to that file
+    best = []
+    for i, old_best, old_best_step in improved:
+        best.append((eval_metrics[i], float(eval_measures[i]), old_best, old_best_step))
+        print("New best for {}. Saving model: /{}".format(eval_metrics[i], best_checkpoint_name(global_step, eval_metrics[i], float(eval_measures[i]))))
+    checkpoint_writer.save_best(global_step, checkpoint, best)
+
+def log_eval_measures(eval_summary_writer, eval_measures, global_step, loss_list, valloss_list):
+    valloss_list.append(eval_measures[:9].tolist())
+    plotgraph(loss_list, valloss_list, path = args.log_directory + "/" + args.model_name, description="")
+    for i in range(9):
+        eval_summary_writer.add_scalar(eval_metrics[i], eval_measures[i].cpu(), int(global_step))
+    eval_summary_writer.flush()
+
+def build_model(args, meta=False):
+    config_vit = CONFIGS_ViT_seg[args.vit_name]
+    config_vit.n_classes = args.num_classes
+    config_vit.n_skip = args.n_skip
+
+    # If Embedding with ResNet
+    if args.vit_name.find("R50") != -1:
+        config_vit.patches.grid = (int(args.input_height / args.patches_size), int(args.input_width / args.patches_size))
+
+    if meta:
+        # no random init, the weights come with materialize() / materialize_pretrained()
+        model = build_on_meta(config_vit, args.img_size, config_vit.n_classes)
+    else:
+        model = ViT_seg(config_vit, img_size=args.img_size, num_classes=config_vit.n_classes)
+    return model, config_vit
+
+def compile_for_shapes(model, args, device, train_shape=True):
+    """--compile: compiles model for the training crop and the online eval frames and reports the cost."""
+    shapes = []
+    if train_shape:
+        shapes.append((args.batch_size, args.img_size[0], args.img_size[1], True))
+    if args.do_online_eval:
+        shapes += eval_shapes(args.eval_batch_size, args.eval_img_size[0], args.eval_img_size[1])
+    start = time.time()
+    method, timings = compile_model(model, shapes, device=device, mode=args.compile_mode, autocast=lambda: autocast(device.type),
+                                    use_script=args.compile == "script")
+    print("Compiled the model with {} in {:.1f}s".format(method, time.time() - start))
+    for (batch, height, width, training), seconds in zip(shapes, timings):
+        print("    {} x {} x {} ({}): {:.1f}s".format(batch, height, width, "train" if training else "eval", seconds))
+
+def async_eval_worker(eval_args, jobs, results):
+    """Evaluator process of --async_eval: scores the snapshots published by AsyncEvaluator."""
+    global args
+    args = eval_args
+    args.distributed = False
+    args.multiprocessing_distributed = False
+    gpu = args.async_eval_gpu if args.async_eval_gpu is not None else (args.gpu if args.gpu is not None else 0)
+    torch.cuda.set_device(gpu)
+    cudnn.benchmark = True
+
+    # materialized from the first snapshot
+    model, _ = build_model(args, meta=True)
+    dataloader_eval = BtsDataLoader(args, "online_eval")
+    checkpoint_writer = CheckpointWriter(args.log_directory + "/" + args.model_name, keep_last=args.keep_checkpoints)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            checkpoint_writer.close()
+            break
+        global_step = job["global_step"]
+        # the snapshot comes from the DataParallel / DDP wrapped model
+        state_dict = strip_module_prefix(job["model"])
+        if next(model.parameters()).is_meta:
+            materialize(model, state_dict, torch.device("cuda", gpu))
+            model.eval()
+            if args.compile:
+                compile_for_shapes(model, args, torch.device("cuda", gpu), train_shape=False)
+        else:
+            model.load_state_dict(state_dict)
+        print("Async eval of step {}".format(global_step))
+        eval_measures = online_eval(model, dataloader_eval, gpu, 1)
+        best_state = job["best_state"]
+        improved = update_best(eval_measures, global_step, *best_state)
+        save_best_checkpoints(checkpoint_writer, improved, eval_measures, global_step, job["model"], job["optimizer"], best_state, job["scaler"])
+        results.put({"global_step": global_step, "eval_measures": eval_measures, "best_state": best_state})
+
 def train(gpu, ngpus_per_node, args):
     args.gpu = gpu
 
@@ -290,25 +374,23 @@ def train(gpu, ngpus_per_node, args):
     
     # logging.info(str(args))
     args.distributed = False
-    config_vit = CONFIGS_ViT_seg[args.vit_name]
-    config_vit.n_classes = args.num_classes
-    config_vit.n_skip = args.n_skip
 
-    # Reinitialize input dim when random crop is True (for TransUNet not MixerUnet)
+    # the full frames of online eval, compiled for with --compile
+    args.eval_img_size = [args.input_height, args.input_width]
+
+    # Reinitialize input dim when random crop is True (MixerUNet resamples its token mixing weights for the full frames at eval)
     if args.do_random_crop == "True":
         args.input_height, args.input_width = args.rcrop_height, args.rcrop_width
 
-    # If Embedding with ResNet
-    if args.vit_name.find("R50") != -1:
-        config_vit.patches.grid = (int(args.input_height / args.patches_size), int(args.input_width / args.patches_size))
-    
-    # img_size: [352, 704] for TransUNet(with random_crop during training)
-    # img_size: [352, 1216] for MixerUNet and TransUNet(withought random_crop)
+    # img_size: [352, 704] with random_crop during training
+    # img_size: [352, 1216] without random_crop
     args.img_size = [args.input_height, args.input_width]
 
     # Create model
-    model = ViT_seg(config_vit, img_size=args.img_size, num_classes=config_vit.n_classes)
-    model.load_from(weights=np.load(config_vit.pretrained_path))
+    model, config_vit = build_model(args, meta=True)
+    # allocated on the gpu and filled from the converted .pth of the npz (convert_pretrained.py) when there is one
+    device = torch.device("cuda", args.gpu) if args.gpu is not None else torch.device("cuda")
+    print("Loaded pretrained weights from {}".format(materialize_pretrained(model, config_vit.pretrained_path, device)))
     model.train()
 
     num_params = sum([np.prod(p.size()) for p in model.parameters()])
@@ -335,13 +417,26 @@ def train(gpu, ngpus_per_node, args):
     else:
         print("Model Initialized")
 
+    if args.grad_checkpoint:
+        device = torch.device("cuda", args.gpu) if args.gpu is not None else torch.device("cuda")
+        with autocast(device.type):
+            checkpointed = set_grad_checkpointing(model.module, args.grad_checkpoint, image_size=args.img_size, batch_size=args.batch_size, device=device)
+        print("Activation checkpointing: {}".format(", ".join("{} {}".format(kind, i) for kind, i in checkpointed)))
+
+    if args.compile:
+        # compiled and warmed for both shapes here, so neither the first steps nor the switch to online eval recompile
+        compile_for_shapes(model.module, args, torch.device("cuda", args.gpu) if args.gpu is not None else torch.device("cuda"))
+
     global_step = 0
     best_eval_measures_lower_better = torch.zeros(6).cpu() + 1e3
     best_eval_measures_higher_better = torch.zeros(3).cpu()
     best_eval_steps = np.zeros(9, dtype=np.int32)
 
     # Training parameters
-    optimizer = optim.SGD(model.parameters(), lr=args.learning_rate, momentum=0.9, weight_decay=0.0001)
+    # fused: the update reads a device-side found_inf and skips non-finite steps without a host sync
+    optimizer = optim.SGD(model.parameters(), lr=args.learning_rate, momentum=0.9, weight_decay=0.0001, fused=True)
+    # fp16 gradients underflow without loss scaling, steps with inf / NaN gradients are skipped by the scaler
+    scaler = torch.amp.GradScaler("cuda", enabled=args.amp == "fp16")
 
     model_just_loaded = False
     if args.checkpoint_path != "":
@@ -353,8 +448,20 @@ def train(gpu, ngpus_per_node, args):
                 loc = "cuda:{}".format(args.gpu)
                 checkpoint = torch.load(args.checkpoint_path, map_location=loc)
             global_step = checkpoint["global_step"]
+            optimizer_state = checkpoint.get("optimizer")  # converted checkpoints (convert_token_mlp_rank.py) have none
+            if optimizer_state is not None and any(k.endswith(".attn.query.weight") for k in checkpoint["model"]):
+                # saved with separate query / key / value: the model weights are packed by the Attention load hook
+                optimizer_state = convert_legacy_optimizer_state(model, optimizer_state)
+                if optimizer_state is None:
+                    print("Could not convert the q/k/v optimizer state of '{}', starting with a fresh optimizer".format(args.checkpoint_path))
             model.load_state_dict(checkpoint["model"])
-            optimizer.load_state_dict(checkpoint["optimizer"])
+            if optimizer_state is not None:
+                optimizer.load_state_dict(optimizer_state)
+                # the saved param groups bring their own (unfused) implementation flags
+                for param_group in optimizer.param_groups:
+                    param_group.update(fused=True, foreach=None)
+            if "scaler" in checkpoint and scaler.is_enabled():
+                scaler.load_state_dict(checkpoint["scaler"])
             try:
                 best_eval_measures_higher_better = checkpoint["best_eval_measures_higher_better"].cpu()
                 best_eval_measures_lower_better = checkpoint["best_eval_measures_lower_better"].cpu()
@@ -373,11 +480,14 @@ def train(gpu, ngpus_per_node, args):
     cudnn.benchmark = True
 
     dataloader = BtsDataLoader(args, "train")
-    dataloader_eval = BtsDataLoader(args, "online_eval")
+    if not args.async_eval:
+        dataloader_eval = BtsDataLoader(args, "online_eval")
 
     # Logging
     if not args.multiprocessing_distributed or (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
         writer = SummaryWriter(args.log_directory + "/" + args.model_name + "/summaries", flush_secs=30)
+        checkpoint_writer = CheckpointWriter(args.log_directory + "/" + args.model_name, keep_last=args.keep_checkpoints)
+        log_worker = LogWorker(writer, downscale=args.log_image_downscale, cmap=args.log_cmap)
         if args.do_online_eval:
             if args.eval_summary_directory != "":
                 eval_summary_path = os.path.join(args.eval_summary_directory, args.model_name)
@@ -385,23 +495,37 @@ def train(gpu, ngpus_per_node, args):
                 eval_summary_path = os.path.join(args.log_directory, "eval")
             eval_summary_writer = SummaryWriter(eval_summary_path, flush_secs=30)
 
+    # With --async_eval only the first rank publishes snapshots, the other ranks never stop for eval
+    evaluator = None
+    if args.do_online_eval and args.async_eval:
+        if not args.multiprocessing_distributed or (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
+            evaluator = AsyncEvaluator(async_eval_worker, args)
+
 
     # # loss function
     silog_criterion = silog_loss(variance_focus=args.variance_focus)
 
     start_time = time.time()
-    duration = 0
+    log_start_time = start_time
 
     num_log_images = args.batch_size
     end_learning_rate = args.end_learning_rate if args.end_learning_rate != -1 else 0.1 * args.learning_rate
 
-    var_sum = [var.sum() for var in model.parameters() if var.requires_grad]
-    var_cnt = len(var_sum)
-    var_sum = torch.FloatTensor(var_sum)
-    var_sum = torch.sum(var_sum)
+    var_sum, var_cnt = TrainMetrics.param_sum([var for var in model.parameters() if var.requires_grad])
+    var_sum = var_sum.item()
 
     print("Initial variables sum: {:.3f}, avg: {:.3f}".format(var_sum, var_sum/var_cnt))
 
+    # loss / NaN flags stay on the gpu and are only read back every log_freq steps
+    train_metrics = TrainMetrics(args.log_freq, device=torch.device("cuda", args.gpu) if args.gpu is not None else torch.device("cuda"))
+
+    batch_augment = None
+    if args.batch_augment:
+        batch_augment = BatchAugment(args.dataset, do_rotate=args.do_random_rotate, degree=args.degree)
+    elif args.raw_transport:
+        # applies the flip / color parameters drawn by the workers
+        batch_augment = BatchAugment(args.dataset)
+
     steps_per_epoch = len(dataloader.data)
     num_total_steps = args.num_epochs * steps_per_epoch
     epoch = global_step // steps_per_epoch
@@ -409,130 +533,129 @@ def train(gpu, ngpus_per_node, args):
     loss_list, valloss_list = [], []
     avg_loss = 0
 
-    while epoch < args.num_epochs:
-        if args.distributed:
-            dataloader.train_sampler.set_epoch(epoch)
-
-        for step, sample_batched in enumerate(dataloader.data):
-            optimizer.zero_grad()
-            before_op_time = time.time()
-
-            image = torch.autograd.Variable(sample_batched["image"].cuda(args.gpu, non_blocking=True))
-            focal = torch.autograd.Variable(sample_batched["focal"].cuda(args.gpu, non_blocking=True))
-            depth_gt = torch.autograd.Variable(sample_batched["depth"].cuda(args.gpu, non_blocking=True))
+    # the evaluator process and the writer threads are shut down on every exit, also the NaN abort
+    try:
+        while epoch < args.num_epochs:
+            if args.distributed:
+                dataloader.train_sampler.set_epoch(epoch)
+
+            for step, sample_batched in enumerate(dataloader.data):
+                optimizer.zero_grad()
+
+                image, depth_gt = sample_batched["image"], sample_batched["depth"]
+                if args.batch_augment != "host":
+                    image, depth_gt = image.cuda(args.gpu, non_blocking=True), depth_gt.cuda(args.gpu, non_blocking=True)
+                if args.raw_transport:
+                    image, depth_gt = decode_raw_batch(image, depth_gt, args.dataset, augment=batch_augment, params=sample_batched.get("augment"))
+                elif args.batch_augment:
+                    image, depth_gt = batch_augment(image, depth_gt)
+                image = torch.autograd.Variable(image.cuda(args.gpu, non_blocking=True))
+                focal = torch.autograd.Variable(sample_batched["focal"].cuda(args.gpu, non_blocking=True))
+                depth_gt = torch.autograd.Variable(depth_gt.cuda(args.gpu, non_blocking=True))
             
-            depth_est = model(image, reshape_size = args.img_size)  # "reshape_size" for reshaping (n_patches, D) => (n_patches, H/16, W/16) before decoding
+                with autocast(image.device.type):
+                    depth_est = model(image)  # the token grid for reshaping (n_patches, D) => (D, H/16, W/16) comes from the embeddings
  
-            mask = depth_gt > 1.0
-
-            loss = silog_criterion.forward(depth_est, depth_gt, mask.to(torch.bool))
-            avg_loss += loss / args.eval_freq
-
-            loss.backward()
-            for param_group in optimizer.param_groups:
-                current_lr = (args.learning_rate - end_learning_rate) * (1 - global_step / num_total_steps) ** 0.9 + end_learning_rate
-                param_group["lr"] = current_lr
-
-            optimizer.step()
-
-            if not args.multiprocessing_distributed or (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
-                print("[epoch][s/s_per_e/gs]: [{}][{}/{}/{}], lr: {:.12f}, loss: {:.12f}".format(epoch, step, steps_per_epoch, global_step, current_lr, loss))
-                if np.isnan(loss.cpu().item()):
-                    print("NaN in loss occurred. Aborting training.")
-                    return -1
-
-            duration += time.time() - before_op_time
-            if global_step and global_step % args.log_freq == 0 and not model_just_loaded:
-                var_sum = [var.sum() for var in model.parameters() if var.requires_grad]
-                var_cnt = len(var_sum)
-                var_sum = torch.FloatTensor(var_sum)
-                var_sum = torch.sum(var_sum)
-                examples_per_sec = args.batch_size / duration * args.log_freq
-                duration = 0
-                time_sofar = (time.time() - start_time) / 3600
-                training_time_left = (num_total_steps / global_step - 1.0) * time_sofar
-                if not args.multiprocessing_distributed or (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
-                    print("{}".format(args.model_name))
-                print_string = "GPU: {} | examples/s: {:4.2f} | loss: {:.5f} | var sum: {:.3f} avg: {:.3f} | time elapsed: {:.2f}h | time left: {:.2f}h"
-                print(print_string.format(args.gpu, examples_per_sec, loss, var_sum.item(), var_sum.item()/var_cnt, time_sofar, training_time_left))
-
-                if not args.multiprocessing_distributed or (args.multiprocessing_distributed
-                                                            and args.rank % ngpus_per_node == 0):
-                    writer.add_scalar("silog_loss", loss, global_step)
-                    writer.add_scalar("learning_rate", current_lr, global_step)
-                    writer.add_scalar("var average", var_sum.item()/var_cnt, global_step)
-                    depth_gt = torch.where(depth_gt < 1e-3, depth_gt * 0 + 1e3, depth_gt)
-                    for i in range(num_log_images):
-                        writer.add_image("depth_gt/image/{}".format(i), normalize_result(1/depth_gt[i, :, :, :].data), global_step)
-                        writer.add_image("depth_est/image/{}".format(i), normalize_result(1/depth_est[i, :, :, :].data), global_step)
-                        # writer.add_image("reduc1x1/image/{}".format(i), normalize_result(1/reduc1x1[i, :, :, :].data), global_step)
-                        # writer.add_image("lpg2x2/image/{}".format(i), normalize_result(1/lpg2x2[i, :, :, :].data), global_step)
-                        # writer.add_image("lpg4x4/image/{}".format(i), normalize_result(1/lpg4x4[i, :, :, :].data), global_step)
-                        # writer.add_image("lpg8x8/image/{}".format(i), normalize_result(1/lpg8x8[i, :, :, :].data), global_step)
-                        writer.add_image("image/image/{}".format(i), inv_normalize(image[i, :, :, :]).data, global_step)
-                    writer.flush()
-
-            if not args.do_online_eval and global_step and global_step % args.save_freq == 0:
-                if not args.multiprocessing_distributed or (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
-                    checkpoint = {"global_step": global_step,
-                                  "model": model.state_dict(),
-                                  "optimizer": optimizer.state_dict()}
-                    torch.save(checkpoint, args.log_directory + "/" + args.model_name + "/model-{}".format(global_step))
-
-
-            if args.do_online_eval and global_step and global_step % args.eval_freq == 0 and not model_just_loaded:
-                time.sleep(0.1)
-                model.eval()
-                eval_measures = online_eval(model, dataloader_eval, gpu, ngpus_per_node)
-                loss_list.append(avg_loss.item())
-                avg_loss = 0
-                valloss_list.append(eval_measures[:9].tolist())
-                plotgraph(loss_list, valloss_list, path = args.log_directory + "/" + args.model_name, description="")
-                if eval_measures is not None:
-                    for i in range(9):
-                        eval_summary_writer.add_scalar(eval_metrics[i], eval_measures[i].cpu(), int(global_step))
-                        measure = eval_measures[i]
-                        is_best = False
-                        if i < 6 and measure < best_eval_measures_lower_better[i]:
-                            old_best = best_eval_measures_lower_better[i].item()
-                            best_eval_measures_lower_better[i] = measure.item()
-                            is_best = True
-                        elif i >= 6 and measure > best_eval_measures_higher_better[i-6]:
-                            old_best = best_eval_measures_higher_better[i-6].item()
-                            best_eval_measures_higher_better[i-6] = measure.item()
-                            is_best = True
-                        if is_best:
-                            old_best_step = best_eval_steps[i]
-                            old_best_name = "/model-{}-best_{}_{:.5f}".format(old_best_step, eval_metrics[i], old_best)
-                            model_path = args.log_directory + "/" + args.model_name + old_best_name
-                            if os.path.exists(model_path):
-                                ##### For Linux
-                                # command = "rm {}".format(model_path)
-                                # os.system(command)
-                                #####
-                                ##### For Windows
-                                os.remove(model_path)
-                                #####
-                            best_eval_steps[i] = global_step
-                            model_save_name = "/model-{}-best_{}_{:.5f}".format(global_step, eval_metrics[i], measure)
-                            print("New best for {}. Saving model: {}".format(eval_metrics[i], model_save_name))
-                            checkpoint = {"global_step": global_step,
-                                          "model": model.state_dict(),
-                                          "optimizer": optimizer.state_dict(),
-                                          "best_eval_measures_higher_better": best_eval_measures_higher_better,
-                                          "best_eval_measures_lower_better": best_eval_measures_lower_better,
-                                          "best_eval_steps": best_eval_steps
-                                          }
-                            torch.save(checkpoint, args.log_directory + "/" + args.model_name + model_save_name)
-                    eval_summary_writer.flush()
-                model.train()
-                block_print()
-                enable_print()
-
-            model_just_loaded = False
-            global_step += 1
-
-        epoch += 1
+                    mask = depth_gt > 1.0
+
+                    loss = silog_criterion.forward(depth_est, depth_gt, mask.to(torch.bool))
+                avg_loss += loss.detach() / args.eval_freq
+
+                scaler.scale(loss).backward()
+                for param_group in optimizer.param_groups:
+                    current_lr = (args.learning_rate - end_learning_rate) * (1 - global_step / num_total_steps) ** 0.9 + end_learning_rate
+                    param_group["lr"] = current_lr
+
+                if scaler.is_enabled():
+                    scaler.step(optimizer)
+                else:
+                    # non-finite gradients are skipped on the device until the NaN abort at the next log step
+                    optimizer.found_inf = train_metrics.found_inf(model.parameters())
+                    optimizer.step()
+                    del optimizer.found_inf
+                scaler.update()
+                train_metrics.update(loss)
+
+                if global_step and global_step % args.log_freq == 0 and not model_just_loaded:
+                    stats = train_metrics.flush([var for var in model.parameters() if var.requires_grad])
+                    var_sum, var_cnt = stats["var_sum"], stats["var_cnt"]
+                    duration = time.time() - log_start_time
+                    log_start_time = time.time()
+                    examples_per_sec = args.batch_size / duration * args.log_freq
+                    time_sofar = (time.time() - start_time) / 3600
+                    training_time_left = (num_total_steps / global_step - 1.0) * time_sofar
+                    if not args.multiprocessing_distributed or (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
+                        print("[epoch][s/s_per_e/gs]: [{}][{}/{}/{}], lr: {:.12f}, loss: {:.12f}, mean loss: {:.12f}".format(epoch, step, steps_per_epoch, global_step, current_lr, stats["loss"], stats["loss_mean"]))
+                        if stats["skipped"]:
+                            print("Skipped {} steps with non-finite gradients".format(stats["skipped"]))
+                        if stats["nan"]:
+                            print("NaN in loss occurred. Aborting training.")
+                            return -1
+                        print("{}".format(args.model_name))
+                    print_string = "GPU: {} | examples/s: {:4.2f} | loss: {:.5f} | var sum: {:.3f} avg: {:.3f} | time elapsed: {:.2f}h | time left: {:.2f}h"
+                    print(print_string.format(args.gpu, examples_per_sec, stats["loss"], var_sum, var_sum/var_cnt, time_sofar, training_time_left))
+
+                    if not args.multiprocessing_distributed or (args.multiprocessing_distributed
+                                                                and args.rank % ngpus_per_node == 0):
+                        writer.add_scalar("silog_loss", stats["loss"], global_step)
+                        writer.add_scalar("learning_rate", current_lr, global_step)
+                        writer.add_scalar("var average", var_sum/var_cnt, global_step)
+                        if scaler.is_enabled():
+                            writer.add_scalar("amp_loss_scale", scaler.get_scale(), global_step)
+                        # normalization, colormapping and the event writes happen on the log worker thread
+                        if not log_worker.log_images(global_step, image, depth_gt, depth_est, num_log_images):
+                            print("Log worker is busy, dropped the images of step {} ({} dropped so far)".format(global_step, log_worker.dropped))
+
+                if not args.do_online_eval and global_step and global_step % args.save_freq == 0:
+                    if not args.multiprocessing_distributed or (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
+                        checkpoint = {"global_step": global_step,
+                                      "model": model.state_dict(),
+                                      "optimizer": optimizer.state_dict()}
+                        if scaler.is_enabled():
+                            checkpoint["scaler"] = scaler.state_dict()
+                        checkpoint_writer.save("model-{}".format(global_step), checkpoint)
+
+
+                if args.do_online_eval and global_step and global_step % args.eval_freq == 0 and not model_just_loaded:
+                    if args.async_eval:
+                        if evaluator is not None:
+                            best_state = (best_eval_measures_lower_better, best_eval_measures_higher_better, best_eval_steps)
+                            if evaluator.publish(global_step, model, optimizer, best_state, scaler.state_dict() if scaler.is_enabled() else None):
+                                loss_list.append(avg_loss.item())
+                            else:
+                                print("Async evaluator is still busy, skipping eval of step {}".format(global_step))
+                        avg_loss = 0
+                    else:
+                        model.eval()
+                        eval_measures = online_eval(model, dataloader_eval, gpu, ngpus_per_node)
+                        loss_list.append(avg_loss.item())
+                        avg_loss = 0
+                        if eval_measures is not None:
+                            best_state = (best_eval_measures_lower_better, best_eval_measures_higher_better, best_eval_steps)
+                            improved = update_best(eval_measures, global_step, *best_state)
+                            save_best_checkpoints(checkpoint_writer, improved, eval_measures, global_step, model.state_dict(), optimizer.state_dict(), best_state,
+                                                  scaler.state_dict() if scaler.is_enabled() else None)
+                            log_eval_measures(eval_summary_writer, eval_measures, global_step, loss_list, valloss_list)
+                        model.train()
+                        block_print()
+                        enable_print()
+
+                if evaluator is not None:
+                    for result in evaluator.poll():
+                        best_eval_measures_lower_better, best_eval_measures_higher_better, best_eval_steps = result["best_state"]
+                        log_eval_measures(eval_summary_writer, result["eval_measures"], result["global_step"], loss_list, valloss_list)
+
+                model_just_loaded = False
+                global_step += 1
+
+            epoch += 1
+    finally:
+        if evaluator is not None:
+            for result in evaluator.close():
+                log_eval_measures(eval_summary_writer, result["eval_measures"], result["global_step"], loss_list, valloss_list)
+        if not args.multiprocessing_distributed or (args.multiprocessing_distributed and args.rank % ngpus_per_node == 0):
+            log_worker.close()
+            checkpoint_writer.close()
 
 
 
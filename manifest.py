@@ -0,0 +1,142 @@
+import os
+import sys
+import argparse
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+# column name -> position in a line of the filenames file
+COLUMNS = {'rgb': 0, 'depth': 1, 'rgb_right': 3, 'depth_right': 4}
+FOCAL_COLUMN = 2
+COLUMN_INDEX = {name: i for i, name in enumerate(COLUMNS)}
+
+
+def split_lines(lines):
+    """Rows of the non-blank lines of a filenames file, the manifest and the packed shards index the same rows."""
+    return [line.split() for line in lines if line.strip()]
+
+
+class Manifest(object):
+    """Array-backed version of a filenames file.
+
+    All paths live in one uint8 blob with an int64 offset table per column, focal lengths are float32
+    and the gt flag / image size / kb-crop margins are small int arrays. Indexing it does no string
+    splitting, and since there are no per-line Python objects, forked DataLoader workers do not copy
+    the pages by touching refcounts.
+    """
+
+    def __init__(self, blob, offsets, focal, has_gt, height=None, width=None, probed=False):
+        self.blob = blob
+        self.offsets = offsets
+        self.focal = focal
+        self.has_gt = has_gt
+        self.height = height
+        self.width = width
+        self.probed = probed
+        self.set_margins()
+
+    def set_margins(self):
+        # kb-crop offsets, as computed in DataLoadPreprocess
+        if self.height is None:
+            self.top_margin = self.left_margin = None
+            return
+        self.top_margin = (self.height.astype(np.int32) - 352).astype(np.int16)
+        self.left_margin = ((self.width.astype(np.int32) - 1216) // 2).astype(np.int16)
+
+    def __len__(self):
+        return self.focal.shape[0]
+
+    def path(self, idx, column='rgb'):
+        offsets = self.offsets[COLUMN_INDEX[column]]
+        return bytes(self.blob[offsets[idx]:offsets[idx + 1]]).decode('utf-8')
+
+    def has_column(self, idx, column):
+        offsets = self.offsets[COLUMN_INDEX[column]]
+        return offsets[idx + 1] > offsets[idx]
+
+    @classmethod
+    def from_lines(cls, lines):
+        rows = split_lines(lines)
+        chunks = []
+        offsets = np.zeros((len(COLUMNS), len(rows) + 1), dtype=np.int64)
+        position = 0
+        for c, column in enumerate(COLUMNS.values()):
+            offsets[c, 0] = position
+            for i, row in enumerate(rows):
+                value = row[column].encode('utf-8') if len(row) > column else b''
+                chunks.append(value)
+                position += len(value)
+                offsets[c, i + 1] = position
+        blob = np.frombuffer(b''.join(chunks), dtype=np.uint8).copy()
+        focal = np.array([float(row[FOCAL_COLUMN]) for row in rows], dtype=np.float32)
+        has_gt = np.array([len(row) > 1 and row[1] != 'None' for row in rows], dtype=bool)
+        return cls(blob, offsets, focal, has_gt)
+
+    @classmethod
+    def from_filenames_file(cls, filenames_file):
+        with open(filenames_file, 'r') as f:
+            return cls.from_lines(f.readlines())
+
+    def probe(self, data_path, gt_path):
+        """Reads image headers once for the size and checks which gt files really exist."""
+        self.height = np.zeros(len(self), dtype=np.int16)
+        self.width = np.zeros(len(self), dtype=np.int16)
+        for idx in tqdm(range(len(self)), desc='probing'):
+            with Image.open(os.path.join(data_path, "./" + self.path(idx, 'rgb'))) as image:
+                self.width[idx], self.height[idx] = image.size
+            if self.has_gt[idx]:
+                self.has_gt[idx] = os.path.isfile(os.path.join(gt_path, "./" + self.path(idx, 'depth')))
+        self.set_margins()
+        self.probed = True
+        return self
+
+    def save(self, path):
+        arrays = {'blob': self.blob, 'offsets': self.offsets, 'focal': self.focal, 'has_gt': self.has_gt}
+        if self.probed:
+            arrays.update(height=self.height, width=self.width)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        probed = 'height' in data.files
+        return cls(data['blob'], data['offsets'], data['focal'], data['has_gt'],
+                   height=data['height'] if probed else None, width=data['width'] if probed else None, probed=probed)
+
+
+def load_manifest(manifest_file, filenames_file):
+    """Compiled manifest if one is given, otherwise an unprobed one built from the filenames file."""
+    if manifest_file:
+        return Manifest.load(manifest_file)
+    return Manifest.from_filenames_file(filenames_file)
+
+
+def convert_arg_line_to_args(arg_line):
+    for arg in arg_line.split():
+        if not arg.strip():
+            continue
+        yield arg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile a filenames file into an array-backed manifest.',
+                                     fromfile_prefix_chars='@')
+    parser.convert_arg_line_to_args = convert_arg_line_to_args
+    parser.add_argument('--filenames_file', type=str, help='path to the filenames text file', default='./train_test_inputs/eigen_train_files_with_gt.txt')
+    parser.add_argument('--data_path',      type=str, help='path to the data', default='../dataset/kitti_dataset/')
+    parser.add_argument('--gt_path',        type=str, help='path to the groundtruth data', default='../dataset/kitti_dataset/data_depth_annotated/')
+    parser.add_argument('--out',            type=str, help='output .npz path', required=True)
+    parser.add_argument('--no_probe',                 help='if set, do not open the images for size and gt existence', action='store_true')
+
+    if sys.argv.__len__() == 2 and not sys.argv[1].startswith('-'):
+        args = parser.parse_args(['@' + sys.argv[1]])
+    else:
+        args = parser.parse_args()
+
+    manifest = Manifest.from_filenames_file(args.filenames_file)
+    if not args.no_probe:
+        manifest.probe(args.data_path, args.gt_path)
+    manifest.save(args.out)
+    print('Wrote manifest for {} lines ({} with gt) to {}'.format(len(manifest), int(manifest.has_gt.sum()), args.out))
@@ -0,0 +1,97 @@
+import time
+import warnings
+import contextlib
+
+import torch
+
+
+def warm_up(model, shapes, device=None, autocast=None):
+    """Runs model once per (batch, height, width, training) shape, with a backward for the training
+    ones, so compilation happens here and not in the first steps. Returns the seconds of every shape.
+    Batch norm statistics and gradients are restored afterwards."""
+    device = device if device is not None else next(model.parameters()).device
+    autocast = autocast if autocast is not None else contextlib.nullcontext
+    buffers = {name: buf.detach().clone() for name, buf in model.named_buffers()}
+    grads = {name: p.grad for name, p in model.named_parameters()}
+    was_training = model.training
+    timings = []
+    try:
+        for batch, height, width, training in shapes:
+            model.train(training)
+            image = torch.zeros(batch, 3, height, width, device=device)
+            # compiled with a symbolic batch, so a last partial batch does not recompile
+            torch._dynamo.maybe_mark_dynamic(image, 0)
+            start = time.time()
+            with autocast(), torch.set_grad_enabled(training):
+                out = model(image)
+            if training:
+                out.float().mean().backward()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            timings.append(time.time() - start)
+    finally:
+        with torch.no_grad():
+            for name, buf in model.named_buffers():
+                buf.copy_(buffers[name])
+        for name, p in model.named_parameters():
+            p.grad = grads[name]
+        model.train(was_training)
+    return timings
+
+
+class TracedForward(object):
+    """Eval-mode forward of a VisionTransformer through one torch.jit.trace graph per input shape.
+
+    The graphs are traced on the first call with a shape and share the parameters of the model.
+    Training mode runs the eager forward.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.forward = model.forward
+        self.graphs = {}
+
+    def __call__(self, x, reshape_size=None):
+        if self.model.training or torch.jit.is_tracing():
+            return self.forward(x)
+        key = (tuple(x.shape), x.dtype, x.device, torch.is_autocast_enabled(x.device.type))
+        if key not in self.graphs:
+            # with grad enabled nothing is served from the no-grad caches (Mixer token weights),
+            # which the trace would record as constants
+            with torch.enable_grad(), warnings.catch_warnings():
+                # the shape dependent branches are meant to be frozen into the graph
+                warnings.simplefilter("ignore", torch.jit.TracerWarning)
+                self.graphs[key] = torch.jit.trace(self.model, x, check_trace=False)
+        return self.graphs[key](x)
+
+
+def eval_shapes(batch, height, width):
+    """Eval warm-up shapes for batches of batch frames: also batch 1 (the last partial batch can be one frame)."""
+    shapes = [(batch, height, width, False)]
+    if batch > 1:
+        shapes.append((1, height, width, False))
+    return shapes
+
+
+def compile_model(model, shapes, device=None, mode=None, autocast=None, use_script=False):
+    """Compiles a VisionTransformer in place and warms it up for every (batch, height, width, training) shape.
+
+    torch.compile is tried first (nn.Module.compile, so the state_dict keys stay the same). The warm-up
+    inputs have a symbolic batch, so other batch sizes reuse the graph, except batch 1, which dynamo
+    always specializes: warm it up as well (eval_shapes()) if it can occur. A new frame size recompiles
+    once, after that the changed dimension is dynamic too. If it is not available or fails, the eval
+    shapes fall back to TorchScript traces and training stays eager. Returns the method that is used,
+    "compile" or "script", and the warm-up seconds per shape.
+    """
+    if not use_script:
+        try:
+            model.compile(dynamic=None, mode=mode)
+            return "compile", warm_up(model, shapes, device, autocast)
+        except Exception as e:
+            print("torch.compile failed, falling back to TorchScript: {}".format(e))
+            model._compiled_call_impl = None
+            torch._dynamo.reset()
+
+    model.forward = TracedForward(model)
+    shapes = [shape for shape in shapes if not shape[3]]
+    return "script", warm_up(model, shapes, device, autocast)
@@ -27,6 +27,7 @@ def get_mixer_b16_config():
     config.hidden_size = 768
     config.num_blocks = 12
     config.tokens_mlp_dim = 384
+    config.tokens_mlp_rank = 0  # > 0: low-rank token mixing MLP of this rank
     config.channels_mlp_dim = 3072
     return config
 def get_r50_mixer_b16_config():
@@ -57,6 +58,7 @@ def get_mixer_l16_config():
     config.hidden_size = 1024
     config.num_blocks = 24
     config.tokens_mlp_dim = 512
+    config.tokens_mlp_rank = 0  # > 0: low-rank token mixing MLP of this rank
     config.channels_mlp_dim = 4096
     return config
 def get_r50_mixer_l16_config():
@@ -88,6 +90,7 @@ def get_mixer_my_config():
     config.hidden_size = 768
     config.num_blocks = 12
     config.tokens_mlp_dim = 3072  # 384*8
+    config.tokens_mlp_rank = 0  # > 0: low-rank token mixing MLP of this rank
     config.channels_mlp_dim = 3072
     return config
 
@@ -112,6 +115,15 @@ def get_r50_mixer_my_config():
 
 
 
+def get_r50_mixer_my_lowrank_config():
+    """Returns the Resnet50 + Mixer-My configuration with a rank 64 token mixing MLP.
+    Initialize it from a dense checkpoint with convert_token_mlp_rank.py."""
+    config = get_r50_mixer_my_config()
+    config.tokens_mlp_rank = 64
+    return config
+
+
+
 def get_b16_config():
     """Returns the ViT-B/16 configuration."""
     config = ml_collections.ConfigDict()
@@ -122,6 +134,7 @@ def get_b16_config():
     config.transformer.num_heads = 12
     config.num_blocks = 12
     config.transformer.attention_dropout_rate = 0.0
+    config.transformer.attention_type = 'global'  # 'global', 'window' or 'shifted_window'
     
     config.dropout_rate = 0.1
     config.classifier = 'seg'
@@ -153,6 +166,14 @@ def get_r50_b16_config():
     config.activation = 'softmax'
     return config
 
+def get_r50_b16_window_config():
+    """Returns the Resnet50 + ViT-B/16 configuration with shifted window attention. Loads R50+ViT-B_16.npz."""
+    config = get_r50_b16_config()
+    config.transformer.attention_type = 'shifted_window'
+    config.transformer.window_size = (11, 11)  # in tokens of the (H/16, W/16) grid, [352, 1216] -> 22 x 76
+    config.transformer.num_global_tokens = 0
+    return config
+
 def get_l16_config():
     """Returns the ViT-L/16 configuration."""
     config = ml_collections.ConfigDict()
@@ -0,0 +1,110 @@
+from collections import defaultdict
+
+import torch
+
+
+def checkpoint_segments(model):
+    """The units that can be checkpointed: ("block", i) for every encoder block (ViT or Mixer) and
+    ("stage", i) for every ResNetV2 body stage of a hybrid model, with the module of each."""
+    transformer = model.transformer
+    segments = [(("block", i), layer) for i, layer in enumerate(transformer.encoder.layer)]
+    if transformer.embeddings.hybrid:
+        segments += [(("stage", i), stage) for i, stage in enumerate(transformer.embeddings.hybrid_model.body)]
+    return segments
+
+
+def saved_activation_bytes(model, image, reshape_size):
+    """Bytes of activations each segment keeps for backward, measured with one training forward of image.
+    Batch norm statistics are restored afterwards."""
+    segments = checkpoint_segments(model)
+    param_ptrs = set(p.data_ptr() for p in model.parameters())
+    current = [None]
+    seen = set()
+    sizes = defaultdict(int)
+
+    def enter(key):
+        def hook(module, inputs):
+            current[0] = key
+        return hook
+
+    def leave(module, inputs, output):
+        current[0] = None
+
+    def pack(t):
+        if current[0] is not None:
+            storage = t.untyped_storage()
+            if storage.data_ptr() not in param_ptrs and storage.data_ptr() not in seen:
+                seen.add(storage.data_ptr())
+                sizes[current[0]] += storage.nbytes()
+        return t
+
+    handles = []
+    for key, module in segments:
+        handles.append(module.register_forward_pre_hook(enter(key)))
+        handles.append(module.register_forward_hook(leave))
+    buffers = {name: buf.detach().clone() for name, buf in model.named_buffers()}
+    was_training = model.training
+    model.train()
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            out = model(image, reshape_size=reshape_size)
+        del out
+    finally:
+        for handle in handles:
+            handle.remove()
+        with torch.no_grad():
+            for name, buf in model.named_buffers():
+                buf.copy_(buffers[name])
+        model.train(was_training)
+    return dict(sizes)
+
+
+def set_grad_checkpointing(model, policy, image_size=None, batch_size=1, device=None):
+    """Applies an activation checkpointing policy to a VisionTransformer (not wrapped in DataParallel).
+
+    policy is a comma separated list of
+        blocks:k     checkpoint every k-th encoder block (k=1: all of them), ViT and Mixer
+        stages       checkpoint every ResNetV2 body stage
+        budget:MB    measure what every block / stage keeps for backward (one forward of a single
+                     image_size image, scaled by batch_size) and checkpoint the largest ones until
+                     the rest fits in MB
+    An empty policy turns checkpointing off. Returns the checkpointed segments.
+    """
+    encoder = model.transformer.encoder
+    resnet = model.transformer.embeddings.hybrid_model if model.transformer.embeddings.hybrid else None
+    encoder.checkpoint_blocks = set()
+    if resnet is not None:
+        resnet.checkpoint_stages = set()
+
+    chosen = set()
+    for item in [p.strip() for p in policy.split(",") if p.strip()]:
+        name, _, value = item.partition(":")
+        if name == "blocks":
+            every = int(value) if value else 1
+            chosen.update(("block", i) for i in range(len(encoder.layer)) if (i + 1) % every == 0)
+        elif name == "stages":
+            if resnet is not None:
+                chosen.update(("stage", i) for i in range(len(resnet.body)))
+        elif name == "budget":
+            if image_size is None:
+                raise ValueError("grad checkpoint budget needs the input image size")
+            budget = float(value) * 1024 ** 2
+            image = torch.zeros(1, 3, image_size[0], image_size[1], device=device)
+            sizes = {key: size * batch_size for key, size in saved_activation_bytes(model, image, image_size).items()}
+            total = sum(sizes.values())
+            for key, size in sorted(sizes.items(), key=lambda kv: -kv[1]):
+                if total <= budget:
+                    break
+                chosen.add(key)
+                total -= size
+            print("Activation memory of blocks / stages: {:.0f} MB, {:.0f} MB after checkpointing {} of them".format(
+                sum(sizes.values()) / 1024 ** 2, total / 1024 ** 2, len(chosen)))
+        else:
+            raise ValueError("unknown grad checkpoint policy '{}'".format(item))
+
+    for kind, i in chosen:
+        if kind == "block":
+            encoder.checkpoint_blocks.add(i)
+        else:
+            resnet.checkpoint_stages.add(i)
+    return sorted(chosen)
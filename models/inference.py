@@ -0,0 +1,71 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from .model import Conv2dReLU, MixerBlock, LowRankLinear, resample_token_weights
+from .resnet_skip import StdConv2d
+
+
+def standardized_conv(conv):
+    """Plain nn.Conv2d with the weight of a StdConv2d standardized once."""
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                      dilation=conv.dilation, groups=conv.groups, bias=conv.bias is not None, padding_mode=conv.padding_mode)
+    with torch.no_grad():
+        v, m = torch.var_mean(conv.weight, dim=[1, 2, 3], keepdim=True, unbiased=False)
+        fused.weight.copy_((conv.weight - m) / torch.sqrt(v + 1e-5))
+        if conv.bias is not None:
+            fused.bias.copy_(conv.bias)
+    return fused.to(conv.weight.device)
+
+
+@torch.no_grad()
+def optimize_for_inference(model, inplace=False):
+    """Returns an eval-mode copy of a VisionTransformer with the weight-only work done once.
+
+    Every StdConv2d of the ResNet becomes an nn.Conv2d with the standardized weight, and the
+    BatchNorm of every Conv2dReLU (decoder) is folded into its conv with the running statistics.
+    The result computes the same function as model.eval(), but can not be trained or saved as a
+    checkpoint of the original model any more.
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, StdConv2d):
+                setattr(module, name, standardized_conv(child))
+
+    for module in model.modules():
+        if isinstance(module, Conv2dReLU) and isinstance(module[1], nn.BatchNorm2d) and module[1].track_running_stats:
+            module[0] = fuse_conv_bn_eval(module[0], module[1])
+            module[1] = nn.Identity()
+    return model
+
+
+@torch.no_grad()
+def bake_token_grid(model, image_size):
+    """Resamples the token mixing MLPs of a Mixer VisionTransformer to the token grid of image_size in place,
+    so the forward at that size runs the plain layers (needed when they are quantized). Returns the grid."""
+    stride_h, stride_w = model.transformer.embeddings.stride
+    pad_bottom, pad_right = model.padding_plan(*image_size)
+    grid = ((image_size[0] + pad_bottom) // stride_h, (image_size[1] + pad_right) // stride_w)
+    for layer in model.transformer.encoder.layer:
+        if not isinstance(layer, MixerBlock) or layer.token_grid == grid:
+            continue
+        mlp = layer.token_mlp_block
+        fc1_weight, fc2_weight, fc2_bias = resample_token_weights(*mlp.token_params(), layer.token_grid, grid)
+        # the layers reading / writing the tokens
+        reader, writer = (mlp.fc1.u, mlp.fc2.v) if isinstance(mlp.fc1, LowRankLinear) else (mlp.fc1, mlp.fc2)
+        reader.weight = nn.Parameter(fc1_weight)
+        writer.weight = nn.Parameter(fc2_weight)
+        writer.bias = nn.Parameter(fc2_bias)
+        for fc in (mlp.fc1, reader):
+            fc.in_features = grid[0] * grid[1]
+        for fc in (mlp.fc2, writer):
+            fc.out_features = grid[0] * grid[1]
+        layer.token_grid = grid
+        layer._token_weights.clear()
+    return grid
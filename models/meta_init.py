@@ -0,0 +1,59 @@
+import numpy as np
+import torch
+
+from .model import VisionTransformer, converted_pretrained_path
+
+
+def build_on_meta(config, img_size, num_classes):
+    """A VisionTransformer whose parameters and buffers live on the meta device: no memory, no random init.
+    It has to go through materialize() (or materialize_pretrained()) before use."""
+    with torch.device("meta"):
+        return VisionTransformer(config, img_size=img_size, num_classes=num_classes)
+
+
+def strip_module_prefix(state_dict):
+    """State dict of a DataParallel / DDP wrapped model for the bare model."""
+    return {k[len("module."):] if k.startswith("module.") else k: v for k, v in state_dict.items()}
+
+
+@torch.no_grad()
+def materialize(model, state_dict=None, device="cpu"):
+    """Allocates the parameters and buffers of a meta-device model on device and fills them from state_dict.
+
+    Only the modules holding something state_dict does not have are initialized, with their own init
+    (_init_weights of Mlp / MlpBlock, reset_parameters of the torch layers and of the Encoder). What is
+    missing comes from load_state_dict, after the load hooks (legacy query / key / value of Attention).
+    Returns the model and the keys that were initialized instead of loaded.
+    """
+    state_dict = state_dict or {}
+    model.to_empty(device=device)
+    missing = set(model.load_state_dict(state_dict, strict=False).missing_keys)
+
+    def initialize(module, prefix):
+        # children first: the _init_weights of Mlp / MlpBlock replaces the default init of their Linears
+        for name, child in module.named_children():
+            initialize(child, prefix + name + ".")
+        own = [prefix + name for name, _ in module.named_parameters(recurse=False)]
+        own += [prefix + name for name, _ in module.named_buffers(recurse=False)]
+        if any(key in missing for key in own) and hasattr(module, "reset_parameters"):
+            module.reset_parameters()
+        if hasattr(module, "_init_weights") and any(key.startswith(prefix) for key in missing):
+            module._init_weights()
+
+    if missing:
+        initialize(model, "")
+        # whatever the initialization touched that state_dict does have is loaded again
+        model.load_state_dict(state_dict, strict=False)
+    return model, sorted(missing)
+
+
+def materialize_pretrained(model, pretrained_path, device="cpu"):
+    """materialize() from the converted pretrained file (convert_pretrained.py) when it fits, otherwise a full
+    initialization followed by load_from() of the npz. Returns the path that was loaded."""
+    state_dict = model.converted_pretrained(pretrained_path)
+    if state_dict is not None:
+        materialize(model, state_dict, device)
+        return converted_pretrained_path(pretrained_path)
+    materialize(model, None, device)
+    model.load_from(weights=np.load(pretrained_path))
+    return pretrained_path
@@ -6,19 +6,23 @@ from __future__ import print_function
 import copy
 import logging
 import math
+import os
 
 from os.path import join as pjoin
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 
 from torch.nn import CrossEntropyLoss, Dropout, Softmax, Linear, Conv2d, LayerNorm
 from torch.nn.modules.utils import _pair
+from torch.utils.checkpoint import checkpoint
 from scipy import ndimage
 
 from . import configs as configs
 from .resnet_skip import ResNetV2
+from .token_merging import TokenMerge
 
 
 logger = logging.getLogger(__name__)
@@ -69,7 +73,8 @@ class silog_loss(nn.Module):
     def forward(self, depth_est, depth_gt, mask):
         # print("depth_est: ", depth_est, "depth_est.shape:", depth_est.shape)
         # print("depth_gt: ", depth_gt, "depth_gt:", depth_gt.shape)
-        d = torch.log(depth_est[mask]) - torch.log(depth_gt[mask])
+        # log differences in fp32, also when the prediction comes out of an autocast region
+        d = torch.log(depth_est[mask].float()) - torch.log(depth_gt[mask].float())
         # print(depth_est[mask])
         # print(depth_gt[mask])
         # print("num of nan depth_est:", torch.sum(torch.isnan(depth_est[mask])))
@@ -89,6 +94,11 @@ class silog_loss(nn.Module):
 
 
 
+def converted_pretrained_path(pretrained_path):
+    """Where convert_pretrained.py writes the torch layout of a pretrained npz."""
+    return os.path.splitext(pretrained_path)[0] + ".pth"
+
+
 def np2th(weights, conv=False):
     """Possibly convert HWIO to OIHW."""
     if conv:
@@ -119,9 +129,8 @@ class Attention(nn.Module):
         self.attention_head_size = int(config.hidden_size / self.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
 
-        self.query = nn.Linear(config.hidden_size, self.all_head_size)
-        self.key = nn.Linear(config.hidden_size, self.all_head_size)
-        self.value = nn.Linear(config.hidden_size, self.all_head_size)
+        # query, key and value projections packed in one Linear, in this order
+        self.qkv = nn.Linear(config.hidden_size, 3 * self.all_head_size)
 
         self.out = nn.Linear(config.hidden_size, config.hidden_size)
         self.attn_dropout = nn.Dropout(config.transformer["attention_dropout_rate"])
@@ -129,30 +138,155 @@ class Attention(nn.Module):
 
         self.softmax = nn.Softmax(dim=-1)
 
-    def transpose_for_scores(self, x):
-        new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
-        x = x.view(*new_x_shape)
-        return x.permute(0, 2, 1, 3)
-
-    def forward(self, hidden_states):
-        mixed_query_layer = self.query(hidden_states)
-        mixed_key_layer = self.key(hidden_states)
-        mixed_value_layer = self.value(hidden_states)
-
-        query_layer = self.transpose_for_scores(mixed_query_layer)
-        key_layer = self.transpose_for_scores(mixed_key_layer)
-        value_layer = self.transpose_for_scores(mixed_value_layer)
-
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        attention_probs = self.softmax(attention_scores)
-        weights = attention_probs if self.vis else None
-        attention_probs = self.attn_dropout(attention_probs)
-
-        context_layer = torch.matmul(attention_probs, value_layer)
-        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
-        context_layer = context_layer.view(*new_context_layer_shape)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the projections were packed have separate query / key / value
+        if prefix + "query.weight" in state_dict:
+            for name in ("weight", "bias"):
+                state_dict[prefix + "qkv." + name] = torch.cat([state_dict.pop(prefix + "query." + name),
+                                                                state_dict.pop(prefix + "key." + name),
+                                                                state_dict.pop(prefix + "value." + name)], dim=0)
+        super(Attention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project(self, hidden_states):
+        B, N, _ = hidden_states.size()
+        qkv = self.qkv(hidden_states).view(B, N, 3, self.num_attention_heads, self.attention_head_size)
+        return qkv.permute(2, 0, 3, 1, 4).unbind(0)  # query, key, value: (B, heads, N, head_size)
+
+    def attend(self, query_layer, key_layer, value_layer, attn_mask=None):
+        """attn_mask: optional bool mask broadcastable to (B, heads, Nq, Nk), True where attending is allowed,
+        or a float bias added to the scores."""
+        if self.vis or not hasattr(F, "scaled_dot_product_attention"):
+            # explicit (B, heads, N, N) scores, only needed when the attention weights are returned
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+            if attn_mask is not None and attn_mask.is_floating_point():
+                attention_scores = attention_scores + attn_mask
+            elif attn_mask is not None:
+                attention_scores = attention_scores.masked_fill(~attn_mask, float("-inf"))
+            attention_probs = self.softmax(attention_scores)
+            weights = attention_probs if self.vis else None
+            attention_probs = self.attn_dropout(attention_probs)
+            return torch.matmul(attention_probs, value_layer), weights
+        dropout_p = self.attn_dropout.p if self.training else 0.
+        return F.scaled_dot_product_attention(query_layer, key_layer, value_layer, attn_mask=attn_mask, dropout_p=dropout_p), None
+
+    def forward(self, hidden_states, grid_size=None, token_merge=None):
+        B, N, _ = hidden_states.size()
+        query_layer, key_layer, value_layer = self.project(hidden_states)
+        attn_mask = None
+        if token_merge is not None:
+            # proportional attention over the merged tokens, the keys are the similarity for the next merge
+            attn_mask = token_merge.attn_bias(query_layer.dtype)
+            token_merge.metric = key_layer.mean(1)
+        context_layer, weights = self.attend(query_layer, key_layer, value_layer, attn_mask)
+        context_layer = context_layer.transpose(1, 2).reshape(B, N, self.all_head_size)
+        attention_output = self.out(context_layer)
+        attention_output = self.proj_dropout(attention_output)
+        return attention_output, weights
+
+
+class WindowAttention(Attention):
+    """Attention restricted to windows of the (H/16, W/16) token grid, linear in the number of tokens.
+
+    Selected with config.transformer.attention_type = "window" or "shifted_window" (see configs.py).
+    With shift, the grid is rolled by half a window first (as in Swin), so alternating blocks connect
+    neighbouring windows. The grid is padded up to a multiple of the window, padded keys are masked.
+    The first num_global_tokens tokens (prepended by the Encoder) attend to every token and every
+    token attends to them. The parameters are the same as Attention, so the pretrained q/k/v load.
+    """
+
+    def __init__(self, config, vis, shift=False):
+        super(WindowAttention, self).__init__(config, vis)
+        self.window_size = _pair(config.transformer["window_size"])
+        self.shift = shift
+        self.num_global_tokens = config.transformer.get("num_global_tokens", 0)
+        self._masks = {}
+
+    def window_layout(self, H, W):
+        wh, ww = min(self.window_size[0], H), min(self.window_size[1], W)
+        sh, sw = (wh // 2 if wh < H else 0, ww // 2 if ww < W else 0) if self.shift else (0, 0)
+        Hp, Wp = int(math.ceil(H / wh)) * wh, int(math.ceil(W / ww)) * ww
+        return wh, ww, sh, sw, Hp, Wp
+
+    def window_mask(self, H, W, device):
+        """(n_windows, wh*ww, wh*ww) bool mask of the windows after padding / shifting, None if nothing is masked."""
+        key = (H, W, str(device))
+        if key not in self._masks:
+            wh, ww, sh, sw, Hp, Wp = self.window_layout(H, W)
+            if (sh, sw) == (0, 0) and (Hp, Wp) == (H, W):
+                self._masks[key] = None
+            else:
+                region = torch.zeros(Hp, Wp, dtype=torch.long, device=device)
+                if sh or sw:
+                    # the rolled-in border strips are separate regions, as in Swin
+                    cnt = 0
+                    for hs in (slice(0, -wh), slice(-wh, -sh or None), slice(-sh or Hp, None)):
+                        for ws in (slice(0, -ww), slice(-ww, -sw or None), slice(-sw or Wp, None)):
+                            region[hs, ws] = cnt
+                            cnt += 1
+                valid = torch.zeros(Hp, Wp, dtype=torch.bool, device=device)
+                valid[:H, :W] = True
+                valid = torch.roll(valid, (-sh, -sw), dims=(0, 1))
+                region = self.to_windows(region.view(1, 1, Hp, Wp, 1), wh, ww)[0, 0, :, :, 0]
+                valid = self.to_windows(valid.view(1, 1, Hp, Wp, 1), wh, ww)[0, 0, :, :, 0]
+                mask = (region.unsqueeze(2) == region.unsqueeze(1)) & valid.unsqueeze(1)
+                # padded queries keep themselves, so no row is fully masked
+                mask |= torch.eye(wh * ww, dtype=torch.bool, device=device)
+                self._masks[key] = mask
+        return self._masks[key]
+
+    @staticmethod
+    def to_windows(x, wh, ww):
+        """(B, heads, Hp, Wp, d) -> (B, heads, n_windows, wh*ww, d)"""
+        B, heads, Hp, Wp, d = x.size()
+        x = x.view(B, heads, Hp // wh, wh, Wp // ww, ww, d).permute(0, 1, 2, 4, 3, 5, 6)
+        return x.reshape(B, heads, (Hp // wh) * (Wp // ww), wh * ww, d)
+
+    @staticmethod
+    def from_windows(x, wh, ww, Hp, Wp):
+        B, heads, _, _, d = x.size()
+        x = x.view(B, heads, Hp // wh, Wp // ww, wh, ww, d).permute(0, 1, 2, 4, 3, 5, 6)
+        return x.reshape(B, heads, Hp, Wp, d)
+
+    def forward(self, hidden_states, grid_size=None):
+        B, L, _ = hidden_states.size()
+        G = self.num_global_tokens
+        H, W = grid_size
+        wh, ww, sh, sw, Hp, Wp = self.window_layout(H, W)
+        query_layer, key_layer, value_layer = self.project(hidden_states)
+        heads, d = query_layer.size(1), query_layer.size(3)
+
+        def windows(x):
+            x = x[:, :, G:].reshape(B, heads, H, W, d)
+            x = F.pad(x, (0, 0, 0, Wp - W, 0, Hp - H))
+            if sh or sw:
+                x = torch.roll(x, (-sh, -sw), dims=(2, 3))
+            return self.to_windows(x, wh, ww)  # (B, heads, nW, wh*ww, d)
+
+        q, k, v = windows(query_layer), windows(key_layer), windows(value_layer)
+        nW = q.size(2)
+        mask = self.window_mask(H, W, hidden_states.device)
+        if G:
+            k = torch.cat([k, key_layer[:, :, None, :G].expand(-1, -1, nW, -1, -1)], dim=3)
+            v = torch.cat([v, value_layer[:, :, None, :G].expand(-1, -1, nW, -1, -1)], dim=3)
+            if mask is not None:
+                mask = torch.cat([mask, mask.new_ones(nW, wh * ww, G)], dim=2)
+        # windows go to the batch dim: (B * nW, heads, wh*ww, d)
+        fold = lambda x: x.transpose(1, 2).reshape(B * nW, heads, x.size(3), d)
+        if mask is not None:
+            mask = mask.unsqueeze(1).repeat(B, 1, 1, 1)
+        context_layer, weights = self.attend(fold(q), fold(k), fold(v), attn_mask=mask)
+
+        context_layer = context_layer.view(B, nW, heads, wh * ww, d).transpose(1, 2)
+        context_layer = self.from_windows(context_layer, wh, ww, Hp, Wp)
+        if sh or sw:
+            context_layer = torch.roll(context_layer, (sh, sw), dims=(2, 3))
+        context_layer = context_layer[:, :, :H, :W].reshape(B, heads, H * W, d)
+        if G:
+            global_context, _ = self.attend(query_layer[:, :, :G], key_layer, value_layer)
+            context_layer = torch.cat([global_context, context_layer], dim=2)
+
+        context_layer = context_layer.transpose(1, 2).reshape(B, L, self.all_head_size)
         attention_output = self.out(context_layer)
         attention_output = self.proj_dropout(attention_output)
         return attention_output, weights
@@ -199,8 +333,13 @@ class Embeddings(nn.Module):
             self.hybrid = True
         else:
             patch_size = _pair(config.patches["size"])
+            patch_size_real = patch_size
             config.n_patches = (img_size[0] // patch_size[0]) * (img_size[1] // patch_size[1])
             self.hybrid = False
+        # input pixels per token, the input is padded to a multiple of it
+        self.stride = tuple(patch_size_real)
+        # token grid at img_size, the grid the Mixer token-mixing weights are defined on
+        config.token_grid = (img_size[0] // patch_size_real[0], img_size[1] // patch_size_real[1])
 
         if self.hybrid:
             self.hybrid_model = ResNetV2(block_units=config.resnet.num_layers, width_factor=config.resnet.width_factor)
@@ -220,29 +359,39 @@ class Embeddings(nn.Module):
         else:
             features = None
         x = self.patch_embeddings(x)  # (B, hidden. config.n_patches^(1/2), config.n_patches^(1/2))
+        grid_size = tuple(x.shape[-2:])
         x = x.flatten(2)
         x = x.transpose(-1, -2)  # (B, n_patches, hidden)
 
         # embeddings = x + self.position_embeddings
         # embeddings = self.dropout(embeddings)
         embeddings = self.dropout(x)
-        return embeddings, features
+        return embeddings, features, grid_size
 
 # Attention Block
 class Block(nn.Module):
-    def __init__(self, config, vis):
+    def __init__(self, config, vis, shift=False):
         super(Block, self).__init__()
         self.hidden_size = config.hidden_size
         self.attention_norm = nn.LayerNorm(config.hidden_size, eps=1e-6)
         self.ffn_norm = nn.LayerNorm(config.hidden_size, eps=1e-6)
         self.ffn = Mlp(config)
-        self.attn = Attention(config, vis)
+        attention_type = config.transformer.get("attention_type", "global")
+        if attention_type == "global":
+            self.attn = Attention(config, vis)
+        else:
+            self.attn = WindowAttention(config, vis, shift=shift and attention_type == "shifted_window")
 
-    def forward(self, x):
+    def forward(self, x, grid_size=None, token_merge=None):
         h = x
         x = self.attention_norm(x)
-        x, weights = self.attn(x)
+        if token_merge is None:
+            x, weights = self.attn(x, grid_size)
+        else:
+            x, weights = self.attn(x, grid_size, token_merge)
         x = x + h
+        if token_merge is not None:
+            x = token_merge.merge(x)
 
         h = x
         x = self.ffn_norm(x)
@@ -279,53 +428,153 @@ class Block(nn.Module):
             value_bias = np2th(weights[pjoin(ROOT, ATTENTION_V, "bias")]).view(-1)
             out_bias = np2th(weights[pjoin(ROOT, ATTENTION_OUT, "bias")]).view(-1)
 
-            self.attn.query.weight.copy_(query_weight)
-            self.attn.key.weight.copy_(key_weight)
-            self.attn.value.weight.copy_(value_weight)
+            self.attn.qkv.weight.copy_(torch.cat([query_weight, key_weight, value_weight], dim=0))
             self.attn.out.weight.copy_(out_weight)
-            self.attn.query.bias.copy_(query_bias)
-            self.attn.key.bias.copy_(key_bias)
-            self.attn.value.bias.copy_(value_bias)
+            self.attn.qkv.bias.copy_(torch.cat([query_bias, key_bias, value_bias], dim=0))
             self.attn.out.bias.copy_(out_bias)
 
 
+def linear_params(fc):
+    """(weight, bias) of an nn.Linear as float tensors, also of a dynamically quantized one, where they are methods."""
+    if callable(fc.weight):
+        return fc.weight().dequantize(), fc.bias()
+    return fc.weight, fc.bias
+
+
+class LowRankLinear(nn.Module):
+    """Linear layer with a rank limited weight v.weight @ u.weight: in_features -> rank -> out_features."""
+    def __init__(self, in_features, out_features, rank):
+        super(LowRankLinear, self).__init__()
+        if rank > min(in_features, out_features):
+            raise ValueError("rank {} does not factorize a {}x{} weight".format(rank, out_features, in_features))
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.u = nn.Linear(in_features, rank, bias=False)
+        self.v = nn.Linear(rank, out_features, bias=True)
+
+    def forward(self, x, u_weight=None, v_weight=None, v_bias=None):
+        x = self.u(x) if u_weight is None else F.linear(x, u_weight)
+        return self.v(x) if v_weight is None else F.linear(x, v_weight, v_bias)
+
+    @torch.no_grad()
+    def load_dense(self, weight, bias=None):
+        """Sets the factors to the truncated SVD of a dense (out_features, in_features) weight, returns the relative error."""
+        weight = weight.float()
+        U, S, Vh = torch.linalg.svd(weight, full_matrices=False)
+        root = S[:self.rank].sqrt()
+        self.v.weight.copy_(U[:, :self.rank] * root)
+        self.u.weight.copy_(root[:, None] * Vh[:self.rank])
+        if bias is not None:
+            self.v.bias.copy_(bias)
+        return (torch.linalg.norm(weight - self.v.weight.float() @ self.u.weight.float()) / torch.linalg.norm(weight)).item()
+
+
 class MlpBlock(nn.Module):
-    def __init__(self, hidden_dim, ff_dim, vis):
+    def __init__(self, hidden_dim, ff_dim, vis, rank=0):
         super(MlpBlock, self).__init__()
         self.vis = vis
-        self.fc1 = nn.Linear(hidden_dim, ff_dim, bias=True)
-        self.fc2 = nn.Linear(ff_dim, hidden_dim, bias=True)
+        if rank:
+            self.fc1 = LowRankLinear(hidden_dim, ff_dim, rank)
+            self.fc2 = LowRankLinear(ff_dim, hidden_dim, rank)
+        else:
+            self.fc1 = nn.Linear(hidden_dim, ff_dim, bias=True)
+            self.fc2 = nn.Linear(ff_dim, hidden_dim, bias=True)
         self.act_fn = nn.GELU()
 
         self._init_weights()
 
     def _init_weights(self):
-        nn.init.xavier_uniform_(self.fc1.weight)
-        nn.init.xavier_uniform_(self.fc2.weight)
-        nn.init.normal_(self.fc1.bias, std=1e-6)
-        nn.init.normal_(self.fc2.bias, std=1e-6)
+        for fc in (self.fc1, self.fc2):
+            if isinstance(fc, LowRankLinear):
+                nn.init.xavier_uniform_(fc.u.weight)
+                nn.init.xavier_uniform_(fc.v.weight)
+                nn.init.normal_(fc.v.bias, std=1e-6)
+            else:
+                nn.init.xavier_uniform_(fc.weight)
+                nn.init.normal_(fc.bias, std=1e-6)
 
-    def forward(self, x):
-        x = self.fc1(x)
+    def token_params(self):
+        """The weights with one entry per token in token mixing: what fc1 reads, what fc2 writes and its bias."""
+        if isinstance(self.fc1, LowRankLinear):
+            fc1, fc2 = self.fc1.u, self.fc2.v
+        else:
+            fc1, fc2 = self.fc1, self.fc2
+        return (linear_params(fc1)[0],) + linear_params(fc2)
+
+    def forward(self, x, fc1_weight=None, fc2_weight=None, fc2_bias=None):
+        # optional replacements of token_params(), see MixerBlock.token_weights
+        if isinstance(self.fc1, LowRankLinear):
+            x = self.fc1(x, u_weight=fc1_weight)
+        else:
+            x = self.fc1(x) if fc1_weight is None else F.linear(x, fc1_weight, linear_params(self.fc1)[1])
         weights = x if self.vis else None
         x = self.act_fn(x)
-        x = self.fc2(x)
+        if isinstance(self.fc2, LowRankLinear):
+            x = self.fc2(x, v_weight=fc2_weight, v_bias=fc2_bias)
+        else:
+            x = self.fc2(x) if fc2_weight is None else F.linear(x, fc2_weight, fc2_bias)
         return x, weights
 
+
+def resample_token_weights(fc1_weight, fc2_weight, fc2_bias, src_grid, dst_grid):
+    """Resamples token-mixing weights defined on a src_grid token grid to dst_grid (bilinear).
+
+    fc1_weight (D, N) reads one column per token, it is rescaled by N_src / N_dst so the sum over the
+    tokens keeps its magnitude; fc2_weight (N, D) and fc2_bias (N,) write one row per token.
+    With the low-rank token MLP these are the u factor of fc1 and the v factor of fc2 (D = rank).
+    """
+    (Hs, Ws), (Hd, Wd) = src_grid, dst_grid
+    if (Hs, Ws) == (Hd, Wd):
+        return fc1_weight, fc2_weight, fc2_bias
+    D = fc1_weight.size(0)
+    resize = lambda w: F.interpolate(w, size=(Hd, Wd), mode="bilinear", align_corners=False)
+    fc1_weight = resize(fc1_weight.reshape(D, 1, Hs, Ws)).reshape(D, Hd * Wd) * (Hs * Ws / (Hd * Wd))
+    fc2_weight = resize(fc2_weight.t().reshape(1, D, Hs, Ws)).reshape(D, Hd * Wd).t()
+    fc2_bias = resize(fc2_bias.reshape(1, 1, Hs, Ws)).reshape(Hd * Wd)
+    return fc1_weight, fc2_weight, fc2_bias
+
+
 # MLP-Mixer Block
 class MixerBlock(nn.Module):
     def __init__(self, config, vis):
         super(MixerBlock, self).__init__()
-        self.token_mlp_block = MlpBlock(config.n_patches, config.tokens_mlp_dim, vis)
+        # the token MLP is sized for the token grid at img_size, other grids use resampled weights
+        self.token_grid = tuple(config.token_grid)
+        self.token_mlp_block = MlpBlock(config.n_patches, config.tokens_mlp_dim, vis, rank=config.get("tokens_mlp_rank", 0))
         self.channel_mlp_block = MlpBlock(config.hidden_size, config.channels_mlp_dim, vis)
         self.pre_norm = nn.LayerNorm(config.hidden_size, eps=1e-6)
         self.post_norm = nn.LayerNorm(config.hidden_size, eps=1e-6)
-
-    def forward(self, x):
+        self._token_weights = {}
+
+    def token_weights(self, grid_size):
+        """Token-mixing weights for grid_size, None for the native grid.
+
+        Without grad the resampled weights are cached per grid and recomputed once the parameters change.
+        """
+        if grid_size is None or tuple(grid_size) == self.token_grid:
+            return None
+        mlp = self.token_mlp_block
+        params = mlp.token_params()
+        if torch.is_grad_enabled():
+            return resample_token_weights(*params, self.token_grid, tuple(grid_size))
+        key = (tuple(grid_size), params[0].device, params[0].dtype)
+        versions = tuple(p._version for p in params)
+        cached = self._token_weights.get(key)
+        if cached is None or cached[0] != versions:
+            cached = (versions, resample_token_weights(*params, self.token_grid, tuple(grid_size)))
+            self._token_weights[key] = cached
+        return cached[1]
+
+    def forward(self, x, grid_size=None):
         h = x
         x = self.pre_norm(x)
         x = x.transpose(-1, -2)
-        x, weights = self.token_mlp_block(x)
+        token_weights = self.token_weights(grid_size)
+        if token_weights is None:
+            x, weights = self.token_mlp_block(x)
+        else:
+            x, weights = self.token_mlp_block(x, *token_weights)
         x = x.transpose(-1, -2)
         x = x + h
 
@@ -342,9 +591,27 @@ class MixerBlock(nn.Module):
     ########## updated #########
     # only token mixing part dim is different
     # possible to load channel mixing part dim
+    ########## updated #########
+    # token mixing weights are resampled from the 14x14 grid when tokens_mlp_dim matches
     def load_from(self, weights, n_block):
         ROOT = f"MixerBlock_{n_block}/"
         with torch.no_grad():
+            tok_weight_0 = np2th(weights[pjoin(ROOT, TOK_FC_0, "kernel")]).t()  # (tokens_mlp_dim, n_tokens)
+            if tok_weight_0.size(0) == self.token_mlp_block.fc1.out_features:
+                side = int(round(math.sqrt(tok_weight_0.size(1))))
+                tok_weight_1 = np2th(weights[pjoin(ROOT, TOK_FC_1, "kernel")]).t()
+                tok_bias_1 = np2th(weights[pjoin(ROOT, TOK_FC_1, "bias")])
+                tok_weight_0, tok_weight_1, tok_bias_1 = resample_token_weights(
+                    tok_weight_0, tok_weight_1, tok_bias_1, (side, side), self.token_grid)
+                tok_bias_0 = np2th(weights[pjoin(ROOT, TOK_FC_0, "bias")])
+                if isinstance(self.token_mlp_block.fc1, LowRankLinear):
+                    self.token_mlp_block.fc1.load_dense(tok_weight_0, tok_bias_0)
+                    self.token_mlp_block.fc2.load_dense(tok_weight_1, tok_bias_1)
+                else:
+                    self.token_mlp_block.fc1.weight.copy_(tok_weight_0)
+                    self.token_mlp_block.fc1.bias.copy_(tok_bias_0)
+                    self.token_mlp_block.fc2.weight.copy_(tok_weight_1)
+                    self.token_mlp_block.fc2.bias.copy_(tok_bias_1)
             # self.token_mlp_block.fc1.weight.copy_(
             #     np2th(weights[pjoin(ROOT, TOK_FC_0, "kernel")]).t())
             # self.token_mlp_block.fc2.weight.copy_(
@@ -375,23 +642,47 @@ class Encoder(nn.Module):
         self.vis = vis
         self.layer = nn.ModuleList()
         self.encoder_norm = nn.LayerNorm(config.hidden_size, eps=1e-6)
+        self.global_tokens = None
+        # indices of the blocks run under activation checkpointing, see models/grad_checkpoint.py
+        self.checkpoint_blocks = set()
+        # tokens merged per block in eval mode, see models/token_merging.py
+        self.merge_rate = 0
         if config.name.find("ViT") != -1:
-            for _ in range(config.num_blocks):
-                layer = Block(config, vis)  # Append Attention Blocks
-                self.layer.append(copy.deepcopy(layer))
+            for i in range(config.num_blocks):
+                layer = Block(config, vis, shift=(i % 2 == 1))  # Append Attention Blocks, every other one shifted in shifted_window mode
+                self.layer.append(layer)
+            num_global_tokens = config.transformer.get("num_global_tokens", 0)
+            if config.transformer.get("attention_type", "global") != "global" and num_global_tokens:
+                self.global_tokens = nn.Parameter(torch.zeros(1, num_global_tokens, config.hidden_size))
+                self.reset_parameters()
         elif config.name.find("Mixer") != -1:
             for _ in range(config.num_blocks): 
                 layer = MixerBlock(config, vis)  # Append MLP-Mixer Blocks
-                self.layer.append(copy.deepcopy(layer))
+                self.layer.append(layer)
 
-    def forward(self, hidden_states):
+    def reset_parameters(self):
+        # the encoder's own parameters, the blocks initialize theirs
+        if self.global_tokens is not None:
+            nn.init.normal_(self.global_tokens, std=0.02)
+
+    def forward(self, hidden_states, grid_size=None):
         attn_weights = []
-        for layer_block in self.layer:
-            hidden_states, weights = layer_block(hidden_states)
+        if self.global_tokens is not None:
+            hidden_states = torch.cat([self.global_tokens.expand(hidden_states.size(0), -1, -1), hidden_states], dim=1)
+        token_merge = TokenMerge(hidden_states, self.merge_rate) if self.merge_rate and not self.training else None
+        for i, layer_block in enumerate(self.layer):
+            if i in self.checkpoint_blocks and self.training and torch.is_grad_enabled():
+                hidden_states, weights = checkpoint(layer_block, hidden_states, grid_size, use_reentrant=False)
+            elif token_merge is not None:
+                hidden_states, weights = layer_block(hidden_states, grid_size, token_merge)
+            else:
+                hidden_states, weights = layer_block(hidden_states, grid_size)
             if self.vis:
                 attn_weights.append(weights)
+        if self.global_tokens is not None:
+            hidden_states = hidden_states[:, self.global_tokens.size(1):]
         encoded = self.encoder_norm(hidden_states)
-        return encoded, attn_weights
+        return encoded, attn_weights, token_merge
 
     # def load_from(self, weights):
     #     ROOT = f"Transformer/"
@@ -407,9 +698,9 @@ class Transformer(nn.Module):
         self.encoder = Encoder(config, vis)
 
     def forward(self, input_ids):
-        embedding_output, features = self.embeddings(input_ids)
-        encoded, attn_weights = self.encoder(embedding_output)  # (B, n_patch, hidden)
-        return encoded, attn_weights, features
+        embedding_output, features, grid_size = self.embeddings(input_ids)
+        encoded, attn_weights, token_merge = self.encoder(embedding_output, grid_size)  # (B, n_patch, hidden), fewer tokens if merged
+        return encoded, attn_weights, features, grid_size, token_merge
 
 class Conv2dReLU(nn.Sequential):
     def __init__(
@@ -508,12 +799,18 @@ class DecoderCup(nn.Module):
         ]
         self.blocks = nn.ModuleList(blocks)
 
-    def forward(self, hidden_states, features=None, reshape_size=[352, 704]):
+    def forward(self, hidden_states, features=None, reshape_size=None, grid_size=None, token_merge=None):
+        if token_merge is not None:
+            # merged tokens back to one per grid cell
+            hidden_states = token_merge.unmerge(hidden_states)
         B, n_patch, hidden = hidden_states.size()  # reshape from (B, n_patch, hidden) to (B, h, w, hidden)
         
-        reshape_size_height = reshape_size[0]
-        reshape_size_width = reshape_size[1]
-        h, w = int(reshape_size_height / 16),  int(reshape_size_width / 16)  # (n_patch, D) -> (D, H/16, W/16)
+        if grid_size is not None:
+            h, w = grid_size  # token grid of the embeddings
+        else:
+            reshape_size_height = reshape_size[0]
+            reshape_size_width = reshape_size[1]
+            h, w = int(reshape_size_height / 16),  int(reshape_size_width / 16)  # (n_patch, D) -> (D, H/16, W/16)
         x = hidden_states.permute(0, 2, 1)
         x = x.contiguous().view(B, hidden, h, w)
         x = self.conv_more(x)
@@ -541,16 +838,69 @@ class VisionTransformer(nn.Module):
             kernel_size=3,
         )
         self.config = config
-
-    def forward(self, x, reshape_size):
+        self._padding_plans = {}
+
+    def padding_plan(self, height, width):
+        """(pad_bottom, pad_right) bringing a height x width input to a multiple of the embedding stride."""
+        stride_h, stride_w = self.transformer.embeddings.stride
+        if torch.compiler.is_compiling():
+            # a lookup in the cache would be guarded on and recompile once it is filled
+            return -height % stride_h, -width % stride_w
+        key = (height, width)
+        if key not in self._padding_plans:
+            self._padding_plans[key] = (-height % stride_h, -width % stride_w)
+        return self._padding_plans[key]
+
+    def forward(self, x, reshape_size=None):
+        # reshape_size is not needed any more: any input size is padded to a multiple of 16 (the token
+        # stride), the token grid comes from the embeddings and the output is cropped back to the input
         if x.size()[1] == 1:
             x = x.repeat(1,3,1,1)
-        x, attn_weights, features = self.transformer(x)  # (B, n_patch, hidden)
-        x = self.decoder(x, features, reshape_size)
+        height, width = x.shape[-2:]
+        pad_bottom, pad_right = self.padding_plan(height, width)
+        if pad_bottom or pad_right:
+            x = F.pad(x, (0, pad_right, 0, pad_bottom))
+        x, attn_weights, features, grid_size, token_merge = self.transformer(x)  # (B, n_patch, hidden)
+        x = self.decoder(x, features, grid_size=grid_size, token_merge=token_merge)
         logits = 80. * self.segmentation_head(x)  # kitti depth_gt가 80 미터 까지라서
+        if pad_bottom or pad_right:
+            logits = logits[:, :, :height, :width]
         return logits
 
+    def converted_pretrained(self, pretrained_path):
+        """The memory-mapped state dict convert_pretrained.py wrote for the npz at pretrained_path, None if there is
+        none, it is older than the npz or it does not fit this model."""
+        converted_path = converted_pretrained_path(pretrained_path)
+        if not os.path.isfile(converted_path) or (os.path.isfile(pretrained_path)
+                                                  and os.path.getmtime(converted_path) < os.path.getmtime(pretrained_path)):
+            return None
+        state_dict = torch.load(converted_path, map_location="cpu", mmap=True, weights_only=True)["state_dict"]
+        own_state = self.state_dict()
+        if all(k in own_state and own_state[k].shape == v.shape for k, v in state_dict.items()):
+            return state_dict
+        # e.g. a Mixer token MLP converted for another token grid
+        logger.info("load_pretrained: %s does not fit the model, loading %s" % (converted_path, pretrained_path))
+        return None
+
+    def load_pretrained(self, pretrained_path):
+        """load_from() with the npz at pretrained_path, or with its converted file (convert_pretrained.py): memory-mapped
+        and copied in, without parsing the npz. Returns the path that was loaded."""
+        state_dict = self.converted_pretrained(pretrained_path)
+        if state_dict is not None:
+            self.load_state_dict(state_dict, strict=False)
+            return converted_pretrained_path(pretrained_path)
+        self.load_from(weights=np.load(pretrained_path))
+        return pretrained_path
+
     def load_from(self, weights):
+        """Copies the npz weights in, returns the state_dict keys it assigned."""
+        # every in-place copy bumps the version counter of its tensor, so a tensor loaded with the value it
+        # already had (a zero bias, a unit norm scale) counts as loaded too
+        versions = {k: v._version for k, v in self.state_dict(keep_vars=True).items()}
+        self._load_from_npz(weights)
+        return sorted(k for k, v in self.state_dict(keep_vars=True).items() if v._version != versions[k])
+
+    def _load_from_npz(self, weights):
         with torch.no_grad():    
             
             # for pretrained R50+ViT-B_16
@@ -615,10 +965,12 @@ CONFIGS = {
     'ViT-L_32': configs.get_l32_config(),
     'ViT-H_14': configs.get_h14_config(),
     'R50-ViT-B_16': configs.get_r50_b16_config(),
+    'R50-ViT-B_16-Window': configs.get_r50_b16_window_config(),
     'R50-ViT-L_16': configs.get_r50_l16_config(),
     'testing': configs.get_testing(),
     'R50-Mixer-B_16': configs.get_r50_mixer_b16_config(),
     'R50-Mixer-L_16': configs.get_r50_mixer_l16_config(),
     'R50-Mixer-My_16': configs.get_r50_mixer_my_config(),
+    'R50-Mixer-My_16-LowRank': configs.get_r50_mixer_my_lowrank_config(),
 }
 
@@ -0,0 +1,66 @@
+import io
+
+import torch
+import torch.nn as nn
+from torch.ao import quantization as tq
+
+from .inference import optimize_for_inference, bake_token_grid
+
+
+def state_dict_bytes(model):
+    """Size of the serialized state_dict, i.e. of a checkpoint of model."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def conv_parents(model):
+    """(parent module, attribute name) of every nn.Conv2d of the ResNet, the decoder and the segmentation head."""
+    roots = [model.decoder, model.segmentation_head]
+    if model.transformer.embeddings.hybrid:
+        roots.insert(0, model.transformer.embeddings.hybrid_model)
+    parents = []
+    for root in roots:
+        for module in root.modules():
+            for name, child in module.named_children():
+                if type(child) is nn.Conv2d:
+                    parents.append((module, name))
+    return parents
+
+
+@torch.no_grad()
+def quantize_static_convs(model, calibration_images):
+    """Static int8 convs: every conv of conv_parents() runs between a quant / dequant pair, the activation
+    ranges are observed on calibration_images (an iterable of (B, 3, H, W) tensors)."""
+    qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+    for module, name in conv_parents(model):
+        wrapper = tq.QuantWrapper(getattr(module, name))
+        wrapper.qconfig = qconfig
+        setattr(module, name, wrapper)
+    tq.prepare(model, inplace=True)
+    num_images = 0
+    for image in calibration_images:
+        model(image)
+        num_images += image.size(0)
+    if not num_images:
+        raise ValueError("static quantization needs calibration images")
+    tq.convert(model, inplace=True)
+    return model
+
+
+def quantize_model(model, image_size, static_convs=False, calibration_images=()):
+    """Returns an int8 copy of a VisionTransformer for cpu inference at image_size.
+
+    The nn.Linear layers of the encoder (Attention, Mlp, MlpBlock and its low-rank factors) are quantized
+    dynamically: int8 weights, activations quantized per batch. With static_convs the ResNet and decoder
+    convs are quantized statically with the ranges of a calibration pass. The weight-only work of
+    optimize_for_inference is done first, and the token mixing MLPs of a Mixer are resampled for
+    image_size once, so that size runs the int8 layers. Other sizes resample the dequantized weights
+    and run the token mixing in fp32.
+    """
+    model = optimize_for_inference(model).cpu()
+    bake_token_grid(model, image_size)
+    if static_convs:
+        quantize_static_convs(model, calibration_images)
+    tq.quantize_dynamic(model.transformer.encoder, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
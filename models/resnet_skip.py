@@ -7,6 +7,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.modules.normalization import GroupNorm
+from torch.utils.checkpoint import checkpoint
 
 def np2th(weights, conv=False):
     """Possibly convert HWIO to OIHW."""
@@ -149,6 +150,14 @@ class ResNetV2(nn.Module):
                 [(f'unit{i:d}', PreActBottleneck(cin=width*16, cout=width*16, cmid=width*4)) for i in range(2, block_units[2] + 1)],
                 ))),
         ]))
+        self.pool = nn.MaxPool2d(kernel_size=3, stride=2, padding=0)
+        # indices of the body stages run under activation checkpointing, see models/grad_checkpoint.py
+        self.checkpoint_stages = set()
+
+    def run_stage(self, i, x):
+        if i in self.checkpoint_stages and self.training and torch.is_grad_enabled():
+            return checkpoint(self.body[i], x, use_reentrant=False)
+        return self.body[i](x)
 
     def forward(self, x):
         features = []
@@ -156,30 +165,26 @@ class ResNetV2(nn.Module):
         b, c, height, width = x.size()
         x = self.root(x)
         features.append(x)
-        x = nn.MaxPool2d(kernel_size=3, stride=2, padding=0)(x)
+        x = self.pool(x)
         for i in range(len(self.body)-1):
-            x = self.body[i](x)
+            x = self.run_stage(i, x)
             # right_size = int(in_size / 4 / (i+1))
             # if x.size()[2] != right_size:
             #     pad = right_size - x.size()[2]
             #     assert pad < 3 and pad > 0, "x {} should {}".format(x.size(), right_size)
             #     feat = torch.zeros((b, x.size()[1], right_size, right_size), device=x.device)
             #     feat[:, :, 0:x.size()[2], 0:x.size()[3]] = x[:]
-            right_height = int(height / 4 / (i+1))
-            right_width = int(width / 4 / (i+1))
+            # integer ops only, so the sizes stay symbolic in a dynamic export
+            right_height = height // (4 * (i+1))
+            right_width = width // (4 * (i+1))
             
-            if x.size()[2] != right_height:
-                pad = right_height - x.size()[2]
-                assert pad < 3 and pad > 0, "x {} should {}".format(x.size(), right_height)
-                feat = torch.zeros((b, x.size()[1], right_height, right_width), device=x.device)
-                feat[:, :, 0:x.size()[2], 0:x.size()[3]] = x[:]
-            elif x.size()[3] != right_width:
-                pad = right_width - x.size()[2]
-                assert pad < 3 and pad > 0, "x {} should {}".format(x.size(), right_width)
-                feat = torch.zeros((b, x.size()[1], right_height, right_width), device=x.device)
-                feat[:, :, 0:x.size()[2], 0:x.size()[3]] = x[:]
+            # the unpadded max pool drops a row / column, zero-pad the skip feature back to size
+            pad_height, pad_width = right_height - x.size()[2], right_width - x.size()[3]
+            if pad_height or pad_width:
+                assert 0 <= pad_height < 3 and 0 <= pad_width < 3, "x {} should {}".format(x.size(), (right_height, right_width))
+                feat = F.pad(x, (0, pad_width, 0, pad_height))
             else:
                 feat = x
             features.append(feat)
-        x = self.body[-1](x)
+        x = self.run_stage(len(self.body)-1, x)
         return x, features[::-1]
\ No newline at end of file
@@ -0,0 +1,74 @@
+import torch
+
+
+class TokenMerge(object):
+    """Token merging (ToMe, Bolya et al. 2023) state of one Encoder forward.
+
+    After the attention of every Block, merge() joins the r most similar token pairs of a bipartite
+    split (even / odd tokens) by a size weighted average, using the keys averaged over the heads as
+    the similarity. size counts the original tokens in every token and biases the attention by its
+    log (proportional attention), source maps every original token to the token it ended up in, so
+    unmerge() can restore the (H/16, W/16) grid for the decoder.
+    """
+
+    def __init__(self, x, r):
+        B, N, _ = x.shape
+        self.r = r
+        self.size = x.new_ones(B, N, 1)
+        self.source = torch.arange(N, device=x.device).expand(B, N)
+        # keys averaged over the heads, set by Attention.forward
+        self.metric = None
+
+    def attn_bias(self, dtype):
+        """(B, 1, 1, N) log sizes added to the attention scores."""
+        return self.size.log().to(dtype).transpose(1, 2).unsqueeze(1)
+
+    def merge(self, x):
+        B, N, C = x.shape
+        r = min(self.r, N // 2)
+        if r <= 0:
+            return x
+        metric = self.metric / self.metric.norm(dim=-1, keepdim=True)
+        scores = metric[:, ::2] @ metric[:, 1::2].transpose(-1, -2)  # (B, Na, Nb)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)
+        unm_idx, src_idx = edge_idx[:, r:], edge_idx[:, :r]  # even tokens kept / merged into their best odd match
+        dst_idx = node_idx.gather(1, src_idx)
+        Na, Nb = (N + 1) // 2, N // 2
+
+        def join(t):
+            src, dst = t[:, ::2], t[:, 1::2]
+            c = t.size(-1)
+            unm = src.gather(1, unm_idx[..., None].expand(-1, -1, c))
+            dst = dst.scatter_add(1, dst_idx[..., None].expand(-1, -1, c), src.gather(1, src_idx[..., None].expand(-1, -1, c)))
+            return torch.cat([unm, dst], dim=1)
+
+        x = join(x * self.size)
+        self.size = join(self.size)
+        x = x / self.size
+
+        # new position of every current token: kept even tokens first, then the odd ones
+        kept = Na - r
+        remap = torch.empty(B, N, dtype=torch.long, device=x.device)
+        remap_even = torch.empty(B, Na, dtype=torch.long, device=x.device)
+        remap_even.scatter_(1, unm_idx, torch.arange(kept, device=x.device).expand(B, kept))
+        remap_even.scatter_(1, src_idx, kept + dst_idx)
+        remap[:, ::2] = remap_even
+        remap[:, 1::2] = kept + torch.arange(Nb, device=x.device)
+        self.source = remap.gather(1, self.source)
+        return x
+
+    def unmerge(self, x):
+        """(B, N_merged, C) -> (B, N, C) in the order of the original tokens."""
+        return x.gather(1, self.source[..., None].expand(-1, -1, x.size(-1)))
+
+
+def set_token_merging(model, r):
+    """Merges r tokens per encoder block in eval mode (0 turns it off). Only for the ViT encoder with
+    global attention, windows and the Mixer token MLPs need the full grid."""
+    from .model import Attention, Block
+    encoder = model.transformer.encoder
+    if r and (encoder.global_tokens is not None
+              or not all(isinstance(layer, Block) and type(layer.attn) is Attention for layer in encoder.layer)):
+        raise ValueError("token merging needs a ViT encoder with global attention")
+    encoder.merge_rate = int(r)
@@ -34,6 +34,13 @@ from tqdm import tqdm
 from dataloader import *
 from models.model import VisionTransformer as ViT_seg
 from models.model import CONFIGS as CONFIGS_ViT_seg
+from models.inference import optimize_for_inference
+from models.compiled import compile_model, eval_shapes
+from models.quantize import quantize_model, state_dict_bytes
+from models.token_merging import set_token_merging
+from models.meta_init import build_on_meta, materialize, strip_module_prefix
+from export_onnx import OnnxModel
+from eval_metrics import DepthMetrics
 
 
 def convert_arg_line_to_args(arg_line):
@@ -57,6 +64,19 @@ parser.add_argument('--dataset', type=str, help='dataset to train on, make3d or
 parser.add_argument('--do_kb_crop', help='if set, crop input images as kitti benchmark images', action='store_true')
 parser.add_argument('--save_lpg', help='if set, save outputs from lpg layers', action='store_true')
 parser.add_argument('--bts_size', type=int,   help='initial num_filters in bts', default=512)
+parser.add_argument('--batch_size', type=int, help='number of images per forward pass', default=1)
+parser.add_argument('--amp', type=str, help='run the model in mixed precision: fp16 or bf16, fp32 if empty', default='', choices=['', 'fp16', 'bf16'])
+parser.add_argument('--compile', type=str, help='compile the model for the input size before testing: inductor (torch.compile) or script (TorchScript)', default='', choices=['', 'inductor', 'script'])
+parser.add_argument('--backend', type=str, help='run the model with pytorch (on --device) or with onnxruntime on the cpu', default='pytorch', choices=['pytorch', 'onnxruntime'])
+parser.add_argument('--device', type=str, help='device the pytorch backend runs the model on: cuda or cpu', default='cuda', choices=['cuda', 'cpu'])
+parser.add_argument('--onnx_path', type=str, help='model written by export_onnx.py, for the onnxruntime backend', default='')
+parser.add_argument('--intra_op_threads', type=int, help='onnxruntime threads within an operator, 0 for the default', default=0)
+parser.add_argument('--inter_op_threads', type=int, help='onnxruntime threads across operators, 0 for the default', default=0)
+parser.add_argument('--quantize', type=str, help='int8 cpu inference: dynamic (encoder linears) or static (also the resnet / decoder convs)', default='', choices=['', 'dynamic', 'static'])
+parser.add_argument('--calibration_batches', type=int, help='number of test batches observed for --quantize static', default=8)
+parser.add_argument('--parity_batches', type=int, help='onnxruntime / quantize: compare this many batches with the fp32 pytorch model on the cpu (default: all with --quantize, none with onnxruntime)', default=None)
+parser.add_argument('--merge_rate', type=int, help='ViT only: tokens merged per encoder block (ToMe), trades accuracy for speed', default=0)
+parser.add_argument('--optimize_inference', help='if set, standardize the ResNet weights once and fold the decoder batch norms before testing', action='store_true')
 
 
 # # # TransUnet args
@@ -95,6 +115,14 @@ sys.path.append(model_dir)
 #     vars()[key] = val
 
 
+AMP_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast(device_type):
+    """Mixed precision region of --amp (a no-op without it) on the device type the model runs on."""
+    return torch.autocast(device_type, dtype=AMP_DTYPES.get(args.amp, torch.float16), enabled=bool(args.amp))
+
+
 def get_num_lines(file_path):
     f = open(file_path, 'r')
     lines = f.readlines()
@@ -102,15 +130,7 @@ def get_num_lines(file_path):
     return len(lines)
 
 
-def test(params):
-    """Test function."""
-    args.mode = 'test'
-    dataloader = BtsDataLoader(args, 'test')
-    
-
-    
-    # logging.info(str(args))
-    args.distributed = False
+def load_model():
     config_vit = CONFIGS_ViT_seg[args.vit_name]
     config_vit.n_classes = args.num_classes
     config_vit.n_skip = args.n_skip
@@ -118,17 +138,75 @@ def test(params):
         config_vit.patches.grid = (int(args.img_size_height / args.vit_patches_size), int(args.img_size_width / args.vit_patches_size))
     args.img_size = [args.img_size_height, args.img_size_width]
     # Create model
-    model = ViT_seg(config_vit, img_size=args.img_size, num_classes=config_vit.n_classes)
+    # built without random init and filled straight from the memory-mapped checkpoint
+    model = build_on_meta(config_vit, args.img_size, config_vit.n_classes)
+    checkpoint = torch.load(args.checkpoint_path, map_location='cpu', mmap=True)
+    materialize(model, strip_module_prefix(checkpoint['model']))
     model = torch.nn.DataParallel(model)
-    
-    checkpoint = torch.load(args.checkpoint_path)
-    model.load_state_dict(checkpoint['model'], strict=False)
     model.eval()
-    model.cuda()
+    if args.merge_rate:
+        set_token_merging(model.module, args.merge_rate)
+    return model
+
+
+def test(params):
+    """Test function."""
+    args.mode = 'test'
+    dataloader = BtsDataLoader(args, 'test')
+    
+
+    
+    # logging.info(str(args))
+    args.distributed = False
+
+    if args.backend == 'onnxruntime':
+        model = OnnxModel(args.onnx_path, intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
+        # the pytorch model on the cpu, only for the parity check
+        reference_model = load_model().module if args.parity_batches else None
+        print('Running {} with onnxruntime'.format(args.onnx_path))
+        run_test(model, dataloader, reference_model=reference_model)
+        return
+
+    if args.quantize:
+        # int8 kernels run on the cpu
+        reference_model = load_model().module
+        calibration_images = []
+        if args.quantize == 'static':
+            calibration_images = [sample['image'] for _, sample in zip(range(args.calibration_batches), dataloader.data)]
+        model = quantize_model(reference_model, (args.input_height, args.input_width), static_convs=args.quantize == 'static',
+                               calibration_images=calibration_images)
+        print('Quantized the model ({}): checkpoint size {:.1f} MB -> {:.1f} MB'.format(
+            args.quantize, state_dict_bytes(reference_model) / 1024 ** 2, state_dict_bytes(model) / 1024 ** 2))
+        if args.parity_batches is None:
+            # the int8 accuracy is always reported against the fp32 model
+            args.parity_batches = len(dataloader.data)
+        run_test(model, dataloader, reference_model=reference_model if args.parity_batches else None)
+        return
+
+    model = load_model()
+    module = model.module
+    if args.device == 'cpu':
+        # DataParallel only runs on gpus
+        model = module
+    model.to(args.device)
+    if args.optimize_inference:
+        optimize_for_inference(module, inplace=True)
+    if args.compile:
+        start = time.time()
+        device = next(model.parameters()).device
+        method, _ = compile_model(module, eval_shapes(args.batch_size, args.input_height, args.input_width),
+                                  device=device, autocast=lambda: autocast(device.type),
+                                  use_script=args.compile == 'script')
+        print('Compiled the model with {} in {:.1f}s'.format(method, time.time() - start))
 
     num_params = sum([np.prod(p.size()) for p in model.parameters()])
     print("Total number of parameters: {}".format(num_params))
+    run_test(model, dataloader)
 
+
+def run_test(model, dataloader, reference_model=None):
+    """Runs model over the test set and saves the predictions. With a reference_model (the fp32 pytorch model
+    on the cpu) the first parity_batches predictions are also scored against it and both are timed."""
     num_test_samples = get_num_lines(args.filenames_file)
 
     with open(args.filenames_file) as f:
@@ -142,16 +220,40 @@ def test(params):
     # pred_2x2s = []
     # pred_1x1s = []
 
+    parity = DepthMetrics(1e-3, args.max_depth)
+    parity_batches, max_diff, model_time, reference_time = 0, 0., 0., 0.
+
     start_time = time.time()
     with torch.no_grad():
-        for _, sample in enumerate(tqdm(dataloader.data)):
-            image = Variable(sample['image'].cuda())
-            focal = Variable(sample['focal'].cuda())
-            # Predict
-            # lpg8x8, lpg4x4, lpg2x2, reduc1x1, depth_est = model(image, focal)
-            depth_est = model(image, reshape_size = args.img_size)
-            
-            pred_depths.append(depth_est.cpu().numpy().squeeze())
+        for batch_index, sample in enumerate(tqdm(dataloader.data)):
+            batch_start = time.time()
+            if args.backend == 'onnxruntime':
+                depth_est = model(sample['image'].numpy())
+            elif args.quantize:
+                depth_est = model(sample['image']).numpy()
+            else:
+                device = next(model.parameters()).device
+                image = Variable(sample['image'].to(device))
+                focal = Variable(sample['focal'].to(device))
+                if args.compile:
+                    # the last partial batch runs the graph compiled for a symbolic batch
+                    torch._dynamo.maybe_mark_dynamic(image, 0)
+                # Predict
+                # lpg8x8, lpg4x4, lpg2x2, reduc1x1, depth_est = model(image, focal)
+                with autocast(device.type):
+                    depth_est = model(image)
+                depth_est = depth_est.float().cpu().numpy()
+            if reference_model is not None and batch_index < args.parity_batches:
+                model_time += time.time() - batch_start
+                reference_start = time.time()
+                reference = reference_model(sample['image']).numpy()
+                reference_time += time.time() - reference_start
+                parity.update(torch.from_numpy(depth_est), torch.from_numpy(reference))
+                max_diff = max(max_diff, np.abs(depth_est - reference).max())
+                parity_batches += 1
+            # samples of a batch are padded to a common size, crop every prediction back to its own size
+            for i, (h, w) in enumerate(sample['size'].tolist()):
+                pred_depths.append(depth_est[i, 0, :h, :w])
             # pred_8x8s.append(lpg8x8[0].cpu().numpy().squeeze())
             # pred_4x4s.append(lpg4x4[0].cpu().numpy().squeeze())
             # pred_2x2s.append(lpg2x2[0].cpu().numpy().squeeze())
@@ -159,6 +261,11 @@ def test(params):
 
     elapsed_time = time.time() - start_time
     print('Elapesed time: %s' % str(elapsed_time))
+    if parity_batches:
+        measures = parity.compute()
+        print('Against the fp32 pytorch model over {} batches: abs_rel {:.5f}, d1 {:.5f}, max abs diff {:.2e}, '
+              '{:.3f}s per batch vs {:.3f}s'.format(parity_batches, measures[1], measures[6], max_diff,
+                                                   model_time / parity_batches, reference_time / parity_batches))
     print('Done.')
     
     
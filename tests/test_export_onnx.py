@@ -0,0 +1,34 @@
+import copy
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from models.model import VisionTransformer, CONFIGS
+from export_onnx import export, OnnxModel, parity
+
+
+def test_dynamic_export_of_hybrid_model(tmp_path):
+    config = copy.deepcopy(CONFIGS["R50-ViT-B_16"])
+    config.n_classes = 1
+    config.n_skip = 3
+    config.patches.grid = (4, 8)
+    model = VisionTransformer(config, img_size=[64, 128], num_classes=1).eval()
+
+    onnx_path = str(tmp_path / "model.onnx")
+    export(model, onnx_path, 64, 128, dynamic=True)
+    onnx_model = OnnxModel(onnx_path)
+    assert onnx_model.dynamic
+
+    # other batch sizes, other multiples of the stride and sizes OnnxModel pads
+    for shape in [(1, 3, 64, 128), (2, 3, 96, 160), (1, 3, 70, 130)]:
+        image = np.random.RandomState(0).randn(*shape).astype(np.float32)
+        max_diff, _ = parity(model, onnx_model, image)
+        assert max_diff < 1e-3
@@ -0,0 +1,72 @@
+import torch
+
+
+class TrainMetrics(object):
+    """Per-step training metrics kept on the training device.
+
+    update() writes the detached loss into a small ring buffer and ors its NaN check into a flag, with
+    device ops only, so a step never waits for the GPU. flush() reduces the window, adds the parameter statistics and
+    brings everything to the host in one transfer; call it at log boundaries.
+
+    A NaN loss is therefore only seen (and training aborted) at the next flush(), up to log_freq steps
+    later. found_inf() keeps those steps from being applied: it is the device flag a fused optimizer
+    skips its update on, as GradScaler does, and it counts the skipped steps for flush().
+    """
+
+    def __init__(self, capacity, device=None):
+        self.capacity = max(int(capacity), 1)
+        self.loss = torch.zeros(self.capacity, device=device)
+        self.nan = torch.zeros((), dtype=torch.bool, device=device)
+        self.skipped = torch.zeros((), device=device)
+        self.count = 0
+
+    def update(self, loss):
+        i = self.count % self.capacity
+        loss = loss.detach()
+        self.loss[i] = loss
+        self.nan |= torch.isnan(loss)
+        self.count += 1
+
+    @torch.no_grad()
+    def found_inf(self, params):
+        """1. if a gradient of params is NaN / inf, else 0., as a device tensor for optimizer.found_inf."""
+        grads = [p.grad for p in params if p.grad is not None]
+        if not grads:
+            return self.skipped.new_zeros(())
+        found = (~torch.stack(torch._foreach_norm(grads)).isfinite().all()).to(self.skipped.dtype)
+        self.skipped += found
+        return found
+
+    @staticmethod
+    @torch.no_grad()
+    def param_sum(params):
+        """Sum of the absolute parameter values (L1) as a device tensor, and the number of parameter tensors.
+
+        One fused foreach norm over all tensors, a signed sum has no foreach kernel.
+        """
+        params = [p.detach() for p in params]
+        if not params:
+            return torch.zeros(()), 0
+        return torch.stack(torch._foreach_norm(params, 1)).sum(), len(params)
+
+    @torch.no_grad()
+    def flush(self, params=None):
+        """Returns the last / mean loss of the window, whether any step was NaN, the number of steps
+        skipped by found_inf() and, if params are given, var_sum / var_cnt as printed by the training
+        loop. Clears the window."""
+        n = min(self.count, self.capacity)
+        last = (self.count - 1) % self.capacity
+        values = [self.loss[last], self.loss[:max(n, 1)].mean(), self.nan.to(self.loss.dtype), self.skipped.to(self.loss.dtype)]
+        var_cnt = 0
+        if params is not None:
+            var_sum, var_cnt = self.param_sum(params)
+            values.append(var_sum.to(self.loss))
+        values = torch.stack(values).cpu().tolist()
+        self.count = 0
+        self.nan.zero_()
+        self.skipped.zero_()
+
+        stats = {"loss": values[0], "loss_mean": values[1], "nan": n > 0 and values[2] > 0, "skipped": int(values[3])}
+        if params is not None:
+            stats.update(var_sum=values[4], var_cnt=var_cnt)
+        return stats